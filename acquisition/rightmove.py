@@ -1,9 +1,9 @@
-import requests
+# Run from the project root: python -m acquisition.rightmove
 from bs4 import BeautifulSoup
-from urllib.parse import urlencode
 
+from python.http_client import make_client
 
-BASE_URL = "https://www.rightmove.co.uk/property-to-rent/find.html?"
+BASE_URL = "https://www.rightmove.co.uk/"
 params = {
     "searchType": "RENT",
     "locationIdentifier": "REGION^1244",
@@ -17,9 +17,10 @@ params = {
 }
 page_number = 0
 last_page = False
+# One client for every page and listing, its connections are reused
+client, _ = make_client(None, None, max_connections=1, base_url=BASE_URL)
 while not last_page:
-    url = BASE_URL + urlencode(params)
-    response = requests.get(url)
+    response = client.get("property-to-rent/find.html", params=params)
 
     soup = BeautifulSoup(response.text, "html.parser")
 
@@ -29,8 +30,7 @@ while not last_page:
         if link["href"] == "":
             last_page = True
             break
-        property_url = "https://www.rightmove.co.uk" + link["href"]
-        property_response = requests.get(property_url)
+        property_response = client.get(link["href"])
         property_soup = BeautifulSoup(property_response.text, "html.parser")
         let_available_date = property_soup.select_one("div._2RnXSVJcWbWv4IpBC1Sng6 dd").text.strip()
         # TODO(soto): make this dataframe
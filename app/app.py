@@ -1,19 +1,43 @@
 import logging
+import math
 import os
 from functools import lru_cache
 
 import dash_bootstrap_components as dbc
 import pandas as pd
-from dash import MATCH, Dash, Input, Output, State, ctx, dcc, html, no_update
+from dash import MATCH, Dash, Input, Output, State, ctx, html, no_update
 from dash.exceptions import PreventUpdate
+from flask import jsonify
 
+from cache import TTLCache
 from data_access import DataAccess
+from property_index import PropertyIndex
 
 logger = logging.getLogger("gunicorn.error")
 logger.setLevel(logging.DEBUG)
 logger.addHandler(logging.StreamHandler())
 
 
+GRID_PAGE_SIZE = int(os.environ.get("GRID_PAGE_SIZE", 30))
+
+# Columns of f_properties used by the app
+COLUMNS = [
+    "property_id",
+    "image",
+    "title",
+    "bedrooms",
+    "bathrooms",
+    "rent_pcm",
+    "let_available_date",
+    "location_name",
+    "description",
+    "property_url",
+    "is_favourite",
+    "is_hidden",
+    "cluster_id",
+    "date_added",
+]
+
 external_stylesheets = [
     dbc.themes.BOOTSTRAP,
     "https://fonts.googleapis.com/css2?family=Material+Symbols+Outlined:opsz,wght,FILL,GRAD@20..48,100..700,0..1,-50..200",
@@ -26,24 +50,68 @@ server = app.server
 
 @lru_cache
 def data_access() -> DataAccess:
-    return DataAccess(
-        project_id=os.environ["PROJECT_ID"],
-        dataset_id=os.environ["DATASET_ID"],
+    # The copy the sync task uploads (LOCAL_MIRROR_URI, gs://...) is downloaded
+    # on start, the image doesn't have one
+    mirror_uri = os.environ.get("LOCAL_MIRROR_URI")
+    local_mirror = os.environ.get("LOCAL_MIRROR")
+    if mirror_uri and local_mirror is None:
+        local_mirror = "/tmp/f_properties.sqlite"
+    access = DataAccess(
+        project_id=os.environ.get("PROJECT_ID", ""),
+        dataset_id=os.environ.get("DATASET_ID", ""),
+        write_interval=float(os.environ.get("WRITE_INTERVAL", 5)),
+        write_batch_size=int(os.environ.get("WRITE_BATCH_SIZE", 50)),
+        local_mirror=local_mirror,
+        warehouse_writes=os.environ.get("WAREHOUSE_WRITES", "true") == "true",
     )
+    if mirror_uri:
+        access.download_mirror(mirror_uri)
+    return access
 
 
-# @lru_cache
-def get_dataframe():
-    df = data_access().get_dataframe(table_id="f_properties")
+def load_dataframe():
+    df = data_access().get_dataframe(
+        table_id="f_properties", columns=COLUMNS, filters=[("is_hidden", "=", 0)]
+    )
+    # Properties hidden since the last write are only hidden in the dataframe
     mask = df["is_hidden"] == 0
-    df = df[mask]
-    print("--------Force reload--------")
+    df = latest_of_clusters(df[mask])
+    logger.info("Properties loaded")
     return df
 
 
+def latest_of_clusters(df: pd.DataFrame) -> pd.DataFrame:
+    """Keep one card per cluster of near-duplicate listings, the latest crawled.
+
+    Favourites are always kept. Properties crawled before the listings were
+    clustered have no cluster_id and stay on their own.
+    """
+    clusters = df["cluster_id"].fillna(df["property_id"])
+    order = df.sort_values("date_added", kind="stable", na_position="first").index
+    latest = ~clusters.loc[order].duplicated(keep="last")
+    favourite = pd.to_numeric(df["is_favourite"], errors="coerce") == 1
+    return df[latest.reindex(df.index) | favourite]
+
+
+def load_index():
+    return PropertyIndex(load_dataframe())
+
+
+# Shared by all threads, refreshed every CACHE_TTL seconds or after an update
+properties_cache = TTLCache(load_index, ttl=float(os.environ.get("CACHE_TTL", 300)))
+
+
+def get_index() -> PropertyIndex:
+    return properties_cache.get()
+
+
+@server.route("/cache-stats")
+def cache_stats():
+    return jsonify(properties_cache.stats())
+
+
 def make_dropdown():
-    df = get_dataframe()
-    options = [{"label": x, "value": x} for x in df["location_name"].unique()]
+    options = [{"label": x, "value": x} for x in get_index().locations]
     return dbc.Select(options=options, id="location-dropdown", class_name="mb-2")
 
 
@@ -190,11 +258,9 @@ def make_grid(df: pd.DataFrame, col_per_row: int = 5):
 
 
 def serve_layout():
-    df = get_dataframe()
+    index = get_index()
     return html.Div(
         [
-            dcc.Store(id="data-store", data=df.to_dict("records")),
-            dcc.Store(id="filtered-data-store", data={}),
             html.H1("Properties"),
             html.Hr(),
             dbc.Accordion(
@@ -203,7 +269,7 @@ def serve_layout():
                         [
                             dbc.Row(
                                 make_grid(
-                                    df=df[df["is_favourite"].astype(bool)],
+                                    df=index.rows(index.query(favourite=True)),
                                     col_per_row=6,
                                 ),
                                 id="favourite-grid",
@@ -218,6 +284,14 @@ def serve_layout():
                 [dbc.Col(make_dropdown(), width=2), dbc.Col(make_sort_by(), width=2)]
             ),
             dbc.Row(id="property-grid"),
+            dbc.Pagination(
+                id="property-pagination",
+                max_value=1,
+                active_page=1,
+                fully_expanded=False,
+                first_last=True,
+                previous_next=True,
+            ),
         ],
         # add 5% padding to left-right 2% padding to top-bottom
         style={"padding": "2% 5%"},
@@ -229,23 +303,26 @@ app.layout = serve_layout
 
 @app.callback(
     Output("property-grid", "children"),
+    Output("property-pagination", "max_value"),
+    Output("property-pagination", "active_page"),
     Input("location-dropdown", "value"),
     Input("sort-by-dropdown", "value"),
-    State("data-store", "data"),
+    Input("property-pagination", "active_page"),
 )
-def update_property_grid(location_name, sort_change, data):
-    df = pd.DataFrame(data).query("is_favourite == 0")
-    if location_name is not None:
-        df = df[df["location_name"] == location_name]
-
-    if sort_change is not None:
-        if sort_change[0] == "-":
-            sort_change = sort_change[1:]
-            df = df.sort_values(by=sort_change, ascending=False)
-        else:
-            df = df.sort_values(by=sort_change)
+def update_property_grid(location_name, sort_change, active_page):
+    # Filter and sort on the server, only the cards of one page are sent
+    index = get_index()
+    ids = index.query(location_name=location_name, sort=sort_change)
+
+    n_pages = max(1, math.ceil(len(ids) / GRID_PAGE_SIZE))
+    # A new filter or sort starts from the first page
+    if ctx.triggered_id != "property-pagination" or not active_page:
+        active_page = 1
+    active_page = min(active_page, n_pages)
 
-    return make_grid(df, col_per_row=6)
+    start = (active_page - 1) * GRID_PAGE_SIZE
+    page = index.rows(ids[start : start + GRID_PAGE_SIZE])
+    return make_grid(page, col_per_row=6), n_pages, active_page
 
 
 @app.callback(
@@ -266,6 +343,7 @@ def favourite_property(n_clicks, className):
                 value="0",
             )
             if result:
+                properties_cache.invalidate()
                 return "material-symbols-outlined"
             else:
                 return no_update
@@ -277,6 +355,7 @@ def favourite_property(n_clicks, className):
                 value="1",
             )
             if result:
+                properties_cache.invalidate()
                 return "material-symbols-outlined fav"
             else:
                 return no_update
@@ -300,6 +379,7 @@ def hide_property(n_clicks):
             value=str(n_clicks % 2),
         )
         if result:
+            properties_cache.invalidate()
             return "visibility_off" if n_clicks % 2 == 1 else "visibility"
         else:
             return no_update
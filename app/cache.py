@@ -0,0 +1,75 @@
+import threading
+import time
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+_EMPTY = object()
+
+
+class TTLCache(Generic[T]):
+    """Cache a single value for `ttl` seconds.
+
+    Only one thread runs the loader at a time, the others wait for its result
+    instead of loading it again. `invalidate` drops the value, including one
+    being loaded at the time.
+    """
+
+    def __init__(self, loader: Callable[[], T], ttl: float):
+        self.loader = loader
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        self._value = _EMPTY
+        self._expires = 0.0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def _cached(self):
+        with self._lock:
+            if self._value is not _EMPTY and time.monotonic() < self._expires:
+                self.hits += 1
+                return self._value
+            return _EMPTY
+
+    def get(self) -> T:
+        if (value := self._cached()) is not _EMPTY:
+            return value
+
+        with self._refresh_lock:
+            # Loaded by another thread while this one waited
+            if (value := self._cached()) is not _EMPTY:
+                return value
+
+            with self._lock:
+                generation = self._generation
+            value = self.loader()
+            with self._lock:
+                self.misses += 1
+                if generation == self._generation:
+                    self._value = value
+                    self._expires = time.monotonic() + self.ttl
+            return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = _EMPTY
+            self._generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "ttl": self.ttl,
+                "age": (
+                    round(self.ttl - (self._expires - time.monotonic()), 1)
+                    if self._value is not _EMPTY
+                    else None
+                ),
+            }
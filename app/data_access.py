@@ -1,31 +1,315 @@
+import atexit
+import logging
+import os
+import re
+import sqlite3
+import threading
+from contextlib import closing
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+import pandas as pd
 from google.cloud import bigquery
 
+logger = logging.getLogger("gunicorn.error")
+
+UPDATABLE_COLUMNS = ("is_favourite", "is_hidden")
+
+# (table_id, property_id) -> {column: value}
+Updates = Dict[Tuple[str, str], Dict[str, int]]
+
+# (column, operator, value)
+Filter = Tuple[str, str, Any]
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+OPERATORS = ("=", "!=", "<", "<=", ">", ">=")
+PARAMETER_TYPES = {
+    bool: "BOOL",
+    int: "INT64",
+    float: "FLOAT64",
+    str: "STRING",
+}
+
+
+class WriteBehindQueue:
+    """Buffer item updates and write them in batches from a background thread.
+
+    Updates to the same item are coalesced, only the last value of each column
+    is written. The buffer is flushed every `interval` seconds, as soon as it
+    holds `max_pending` items and when the process exits.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[Updates], None],
+        interval: float = 5.0,
+        max_pending: int = 50,
+    ):
+        self._flush = flush
+        self.interval = interval
+        self.max_pending = max_pending
+        self.pending: Updates = {}
+        self.in_flight: Updates = {}
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, table_id: str, property_id: str, key: str, value: int):
+        with self._lock:
+            self.pending.setdefault((table_id, property_id), {})[key] = value
+            if len(self.pending) >= self.max_pending:
+                self._wake.set()
+
+    def overlay(self, table_id: str) -> Dict[str, Dict[str, int]]:
+        """Updates not written yet, to apply over what's read from the table"""
+        with self._lock:
+            updates = {}
+            for source in (self.in_flight, self.pending):
+                for (table, property_id), values in source.items():
+                    if table == table_id:
+                        updates.setdefault(property_id, {}).update(values)
+            return updates
+
+    def flush(self):
+        with self._lock:
+            if not self.pending:
+                return
+            self.in_flight, self.pending = self.pending, {}
+
+        try:
+            self._flush(self.in_flight)
+        except Exception as e:
+            logger.error(f"Failed to write {len(self.in_flight)} updates: {e}")
+            with self._lock:
+                # Put them back under anything newer clicked in the meantime
+                for item, values in self.in_flight.items():
+                    self.pending[item] = {**values, **self.pending.get(item, {})}
+        finally:
+            with self._lock:
+                self.in_flight = {}
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout=self.interval)
+        self.flush()
+
 
 class DataAccess:
-    def __init__(self, project_id: str, dataset_id: str):
-        self.client = bigquery.Client()
+    def __init__(
+        self,
+        project_id: str,
+        dataset_id: str,
+        write_interval: float = 5.0,
+        write_batch_size: int = 50,
+        local_mirror: Optional[str] = None,
+        warehouse_writes: bool = True,
+    ):
         self.dataset = f"{project_id}.{dataset_id}"
+        self.bytes_processed = 0
+        self._client: Optional[bigquery.Client] = None
+        self._client_lock = threading.Lock()
+        # Reads go to the local sqlite copy when there is one, writes to both.
+        # Without warehouse writes the flags are only kept in the local copy,
+        # which is then never synced from the warehouse again
+        self.local_mirror = local_mirror
+        self.writes = None
+        if warehouse_writes or local_mirror is None:
+            self.writes = WriteBehindQueue(
+                self.write_updates,
+                interval=write_interval,
+                max_pending=write_batch_size,
+            )
+
+    @property
+    def client(self) -> bigquery.Client:
+        """Created on first use, reading from the local copy needs no credentials"""
+        with self._client_lock:
+            if self._client is None:
+                self._client = bigquery.Client()
+            return self._client
+
+    def download_mirror(self, uri: str):
+        """Replace the local copy by the one the sync task uploaded to `uri`.
 
-    def get_dataframe(self, table_id: str):
-        """Get a dataframe from a table"""
-        QUERY = f"SELECT * FROM `{self.dataset}.{table_id}`"
-        query_job = self.client.query(QUERY)  # API request
+        The copy has the flags as they were on its sync, they are read again
+        from the warehouse when writes go there.
+        """
+        from google.cloud import storage
+
+        download = f"{self.local_mirror}.download"
+        storage.Blob.from_string(uri, client=storage.Client()).download_to_filename(
+            download
+        )
+        os.replace(download, self.local_mirror)
+        logger.info(f"Local copy downloaded from {uri}")
+        if self.writes is None:
+            return
+
+        flags = self.get_warehouse_dataframe(
+            "f_properties", ["property_id", *UPDATABLE_COLUMNS], ()
+        )
+        with closing(sqlite3.connect(self.local_mirror)) as db, db:
+            db.executemany(
+                "UPDATE f_properties SET is_favourite = ?, is_hidden = ? "
+                "WHERE property_id = ?",
+                flags[["is_favourite", "is_hidden", "property_id"]].itertuples(
+                    index=False, name=None
+                ),
+            )
+
+    def get_dataframe(
+        self,
+        table_id: str,
+        columns: Optional[Sequence[str]] = None,
+        filters: Sequence[Filter] = (),
+    ):
+        """Get a dataframe from a table
+
+        Only `columns` are read (all by default), from the rows matching every
+        `(column, operator, value)` in `filters`. Values are sent as query
+        parameters, a list value is matched with the IN operator.
+        """
+        if not IDENTIFIER.fullmatch(table_id):
+            raise ValueError(f"Invalid table name {table_id}")
+        for column in [*(columns or []), *(f[0] for f in filters)]:
+            if not IDENTIFIER.fullmatch(column):
+                raise ValueError(f"Invalid column name {column}")
+
+        if self.local_mirror is not None:
+            df = self.get_local_dataframe(table_id, columns, filters)
+        else:
+            df = self.get_warehouse_dataframe(table_id, columns, filters)
+
+        if self.writes is None:
+            return df
+        # Show the updates that are still queued
+        for property_id, values in self.writes.overlay(table_id).items():
+            for key, value in values.items():
+                df.loc[df["property_id"] == property_id, key] = value
+        return df
+
+    def get_warehouse_dataframe(
+        self,
+        table_id: str,
+        columns: Optional[Sequence[str]],
+        filters: Sequence[Filter],
+    ):
+        conditions = []
+        parameters = []
+        for n, (column, operator, value) in enumerate(filters):
+            if operator.upper() == "IN":
+                conditions.append(f"{column} IN UNNEST(@p{n})")
+                parameters.append(
+                    bigquery.ArrayQueryParameter(
+                        f"p{n}", PARAMETER_TYPES[type(value[0])], list(value)
+                    )
+                )
+            elif operator in OPERATORS:
+                conditions.append(f"{column} {operator} @p{n}")
+                parameters.append(
+                    bigquery.ScalarQueryParameter(
+                        f"p{n}", PARAMETER_TYPES[type(value)], value
+                    )
+                )
+            else:
+                raise ValueError(f"Invalid operator {operator}")
+
+        select = ", ".join(columns) if columns else "*"
+        QUERY = f"SELECT {select} FROM `{self.dataset}.{table_id}`"
+        if conditions:
+            QUERY += f" WHERE {' AND '.join(conditions)}"
+        job_config = bigquery.QueryJobConfig(query_parameters=parameters)
+        query_job = self.client.query(QUERY, job_config=job_config)  # API request
         rows = query_job.result()  # Waits for query to finish
-        df = rows.to_dataframe()
+        # Downloads Arrow record batches through the BigQuery Storage API
+        df = rows.to_arrow(create_bqstorage_client=True).to_pandas()
+
+        self.bytes_processed += query_job.total_bytes_processed or 0
+        logger.info(
+            f"Read {len(df)} rows from {table_id}, "
+            f"{query_job.total_bytes_processed or 0} bytes processed"
+        )
         return df
 
-    def update_item(self, table_id: str, property_id: str, key: str, value: str):
-        """Update a single item in the database"""
-        query = f"""
-        UPDATE `{self.dataset}.{table_id}`
-        SET {key} = {value}
+    def get_local_dataframe(
+        self,
+        table_id: str,
+        columns: Optional[Sequence[str]],
+        filters: Sequence[Filter],
+    ):
+        conditions = []
+        parameters = []
+        for column, operator, value in filters:
+            if operator.upper() == "IN":
+                conditions.append(f"{column} IN ({', '.join('?' for _ in value)})")
+                parameters.extend(value)
+            elif operator in OPERATORS:
+                conditions.append(f"{column} {operator} ?")
+                parameters.append(value)
+            else:
+                raise ValueError(f"Invalid operator {operator}")
 
-        WHERE property_id = '{property_id}'
-        """
-        try:
-            query_job = self.client.query(query)
-            query_job.result()
-        except Exception as e:
-            print(e)
+        select = ", ".join(columns) if columns else "*"
+        QUERY = f"SELECT {select} FROM {table_id}"
+        if conditions:
+            QUERY += f" WHERE {' AND '.join(conditions)}"
+        with closing(sqlite3.connect(self.local_mirror)) as db:
+            return pd.read_sql_query(QUERY, db, params=parameters)
+
+    def update_item(self, table_id: str, property_id: str, key: str, value: str):
+        """Queue an update of a single item, written in the next batch"""
+        if key not in UPDATABLE_COLUMNS or not IDENTIFIER.fullmatch(table_id):
+            logger.error(f"Column {key} of {table_id} can't be updated")
             return False
+        if self.writes is not None:
+            self.writes.put(table_id, property_id, key, int(value))
+        if self.local_mirror is not None:
+            with closing(sqlite3.connect(self.local_mirror)) as db, db:
+                db.execute(
+                    f"UPDATE {table_id} SET {key} = ? WHERE property_id = ?",
+                    (int(value), property_id),
+                )
         return True
+
+    def write_updates(self, updates: Updates):
+        """Write a batch of item updates with one MERGE per table"""
+        tables = {}
+        for (table_id, property_id), values in updates.items():
+            tables.setdefault(table_id, []).append(
+                bigquery.StructQueryParameter(
+                    None,
+                    bigquery.ScalarQueryParameter("property_id", "STRING", property_id),
+                    *(
+                        bigquery.ScalarQueryParameter(
+                            column, "INT64", values.get(column)
+                        )
+                        for column in UPDATABLE_COLUMNS
+                    ),
+                )
+            )
+
+        for table_id, rows in tables.items():
+            query = f"""
+            MERGE `{self.dataset}.{table_id}` AS t
+            USING UNNEST(@updates) AS u
+               ON t.property_id = u.property_id
+             WHEN MATCHED THEN
+                  UPDATE SET is_favourite = COALESCE(u.is_favourite, t.is_favourite)
+                           , is_hidden = COALESCE(u.is_hidden, t.is_hidden)
+            """
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ArrayQueryParameter("updates", "STRUCT", rows)
+                ]
+            )
+            self.client.query(query, job_config=job_config).result()
@@ -0,0 +1,59 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+SORT_KEYS = ("rent_pcm", "bedrooms", "bathrooms")
+
+
+class PropertyIndex:
+    """Row ids of the properties, presorted for every location and sort order.
+
+    Built once per data refresh, so filtering on a location and sorting is a
+    lookup of the matching id array and dropping the favourites from it.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df.reset_index(drop=True)
+        self.is_favourite = (
+            pd.to_numeric(self.df["is_favourite"], errors="coerce").fillna(0).to_numpy()
+            == 1
+        )
+
+        codes, self.locations = pd.factorize(self.df["location_name"], sort=True)
+
+        self.orders: Dict[Tuple[Optional[str], Optional[str]], np.ndarray] = {}
+        perms = {None: np.arange(len(self.df))}
+        for key in SORT_KEYS:
+            # Numeric columns, rows loaded before they were typed may still be text
+            values = pd.to_numeric(self.df[key], errors="coerce").to_numpy(float)
+            # Properties without a value go last in both directions
+            perms[key] = np.argsort(np.nan_to_num(values, nan=np.inf), kind="stable")
+            perms[f"-{key}"] = np.argsort(
+                -np.nan_to_num(values, nan=-np.inf), kind="stable"
+            )
+
+        for sort, perm in perms.items():
+            self.orders[(None, sort)] = perm
+            # Group the sorted ids by location, keeping their order
+            by_location = perm[np.argsort(codes[perm], kind="stable")]
+            counts = np.bincount(codes[codes >= 0], minlength=len(self.locations))
+            bounds = np.cumsum(counts)
+            offset = np.count_nonzero(codes < 0)
+            for code, ids in enumerate(np.split(by_location[offset:], bounds[:-1])):
+                self.orders[(self.locations[code], sort)] = ids
+
+    def query(
+        self,
+        location_name: Optional[str] = None,
+        sort: Optional[str] = None,
+        favourite: bool = False,
+    ) -> np.ndarray:
+        """Ids of the matching rows in sort order"""
+        ids = self.orders.get((location_name, sort))
+        if ids is None:
+            return np.empty(0, dtype=int)
+        return ids[self.is_favourite[ids] == favourite]
+
+    def rows(self, ids: np.ndarray) -> pd.DataFrame:
+        return self.df.iloc[ids]
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""Parser micro-benchmark and regression gate.
+
+Parses every page of a corpus of saved listing and search pages with each
+parser backend and checks the fields against the golden records in
+<corpus>/golden.json: the raw listing fields, the normalised record (None
+when the listing is filtered out), and the search cards and result count.
+
+Each stage is timed per page (building the tree, each extraction step of the
+backend, the whole parse) and the median over --repeat runs is kept.
+Normalisation runs on chunks, so it's timed on a chunk of the corpus listings
+and reported per listing. The per-page cost of each stage, averaged over the
+corpus, is compared to the baseline saved with --save-baseline (committed as
+parser_baseline.json); the run fails on any golden mismatch, when a stage got
+slower than the baseline by more than --threshold, or when there's no baseline
+for a parser. A parser with a regression is timed again and the faster of
+the two timings of each stage is kept, so a burst of noise doesn't fail the run.
+Timings only compare on the same machine: the committed baseline is the
+median of three runs, save a new one on the machine the gate runs on.
+
+    python -m benchmarks.bench_parsers
+    python -m benchmarks.bench_parsers --parsers selectolax --save-baseline
+
+Corpus versions are directories of benchmarks/corpus; pages are added to a new
+version rather than changed in place, so timings stay comparable.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+from python.normalize import normalize_listings
+from python.parsers import PARSERS, empty_listing, get_parser
+
+CORPUS = Path(__file__).parent / "corpus" / "v1"
+BASELINE = Path(__file__).parent / "parser_baseline.json"
+# Rows in the chunk normalisation is timed on, as the crawler's chunk_size
+CHUNK_SIZE = 500
+# Stages cheaper than this are below the timer noise, they aren't gated
+MIN_GATED_US = 5.0
+
+
+def time_us(function: Callable[[], Any], repeat: int) -> float:
+    """Median time of a call, in microseconds"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1e6
+
+
+def listing_stub(page: Path) -> Dict[str, str]:
+    """The search card fields the details task adds to the listing"""
+    return {
+        "property_id": page.stem,
+        "property_url": f"/properties/{page.stem}",
+        "location_name": "London",
+        "title": page.stem.replace("_", " "),
+        "image": "",
+        "description": "",
+        "cluster_id": page.stem,
+    }
+
+
+def normalise(page: Path, listing: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    batch, _ = normalize_listings([dict(listing, **listing_stub(page))])
+    if len(batch) == 0:
+        return None
+    values = next(iter(batch))
+    del values["date_added"]
+    if values["size"] is not None:
+        values["size"] = round(values["size"], 4)
+    return values
+
+
+def extract(parser, page: Path) -> Dict[str, Any]:
+    html = page.read_text()
+    if page.name.startswith("listing"):
+        listing = parser.parse_listing(html)
+        return {"listing": listing, "record": normalise(page, listing)}
+    cards, result_count = parser.parse_search_page(html)
+    return {"cards": cards, "result_count": result_count}
+
+
+def diff(expected: Any, got: Any, path: str) -> List[str]:
+    if isinstance(expected, dict) and isinstance(got, dict):
+        return [
+            line
+            for k in sorted(set(expected) | set(got))
+            for line in diff(expected.get(k), got.get(k), f"{path}.{k}")
+        ]
+    if (
+        isinstance(expected, list)
+        and isinstance(got, list)
+        and len(expected) == len(got)
+    ):
+        return [
+            line
+            for i, (e, g) in enumerate(zip(expected, got))
+            for line in diff(e, g, f"{path}[{i}]")
+        ]
+    if expected != got:
+        return [f"{path}: expected {expected!r}, got {got!r}"]
+    return []
+
+
+def time_page(parser, page: Path, repeat: int) -> Dict[str, float]:
+    html = page.read_text()
+    if not page.name.startswith("listing"):
+        return {
+            "parse_search_page": time_us(
+                lambda: parser.parse_search_page(html), repeat
+            ),
+            "parse_search": time_us(lambda: parser.parse_search(html), repeat),
+            "parse_result_count": time_us(
+                lambda: parser.parse_result_count(html), repeat
+            ),
+        }
+
+    timings = {
+        "tree": time_us(lambda: parser.tree(html), repeat),
+        "parse_listing": time_us(lambda: parser.parse_listing(html), repeat),
+    }
+    tree = parser.tree(html)
+    for stage in parser.listing_stages:
+        step = getattr(parser, stage)
+        timings[stage] = time_us(lambda: step(tree, empty_listing()), repeat)
+    return timings
+
+
+def time_normalize(parser, pages: List[Path], repeat: int) -> Optional[float]:
+    """Normalisation time per listing, on a chunk of the corpus listings"""
+    rows = [
+        dict(parser.parse_listing(page.read_text()), **listing_stub(page))
+        for page in pages
+        if page.name.startswith("listing")
+    ]
+    if not rows:
+        return None
+    chunk = (rows * (CHUNK_SIZE // len(rows) + 1))[:CHUNK_SIZE]
+    return time_us(lambda: normalize_listings(chunk), repeat) / CHUNK_SIZE
+
+
+def bench(parser_name: str, pages: List[Path], golden: Mapping[str, Any], repeat: int):
+    """Return (mismatches, mean per-page cost of each stage in microseconds)"""
+    parser = get_parser(parser_name)
+    mismatches = []
+    per_stage: Dict[str, List[float]] = {}
+    for page in pages:
+        if page.name not in golden:
+            mismatches.append(f"{page.name}: no golden record")
+        else:
+            mismatches += diff(golden[page.name], extract(parser, page), page.name)
+
+        for stage, us in time_page(parser, page, repeat).items():
+            per_stage.setdefault(stage, []).append(us)
+
+    costs = {k: round(statistics.mean(v), 1) for k, v in per_stage.items()}
+    if (us := time_normalize(parser, pages, repeat)) is not None:
+        costs["normalize"] = round(us, 1)
+    return mismatches, costs
+
+
+def regressions(
+    results: Mapping[str, Mapping[str, float]],
+    baseline: Mapping[str, Mapping[str, float]],
+    threshold: float,
+) -> List[str]:
+    found = []
+    for parser_name, stages in results.items():
+        if parser_name not in baseline:
+            found.append(f"{parser_name}: no baseline")
+            continue
+        for stage, us in stages.items():
+            base = baseline.get(parser_name, {}).get(stage)
+            if base is None or max(base, us) < MIN_GATED_US:
+                continue
+            if us > base * (1 + threshold):
+                found.append(
+                    f"{parser_name} {stage}: {us}us per page vs {base}us"
+                    f" ({us / base - 1:+.0%})"
+                )
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", type=Path, default=CORPUS)
+    parser.add_argument("--parsers", nargs="+", choices=PARSERS, default=list(PARSERS))
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument(
+        "--update-golden",
+        action="store_true",
+        help="Write the golden records from the bs4 backend, review the diff",
+    )
+    args = parser.parse_args()
+
+    pages = sorted(args.corpus.glob("*.html"))
+    golden_path = args.corpus / "golden.json"
+    if args.update_golden:
+        golden = {page.name: extract(get_parser("bs4"), page) for page in pages}
+        golden_path.write_text(json.dumps(golden, indent=2, ensure_ascii=False) + "\n")
+        print(f"Wrote {len(golden)} golden records to {golden_path}")
+        return
+    golden = json.loads(golden_path.read_text())
+
+    failed = False
+    results = {}
+    for parser_name in args.parsers:
+        mismatches, results[parser_name] = bench(
+            parser_name, pages, golden, args.repeat
+        )
+        if mismatches:
+            failed = True
+            print(f"{parser_name} doesn't match the golden records:")
+            print("  " + "\n  ".join(mismatches))
+
+    print(f"Per-page cost (us) over {len(pages)} pages of {args.corpus.name}:")
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Saved the baseline to {args.baseline}")
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        for parser_name, stages in results.items():
+            if regressions({parser_name: stages}, baseline, args.threshold):
+                print(f"Timing {parser_name} again")
+                _, again = bench(parser_name, pages, golden, args.repeat)
+                results[parser_name] = {
+                    stage: min(us, again.get(stage, us)) for stage, us in stages.items()
+                }
+        if found := regressions(results, baseline, args.threshold):
+            failed = True
+            print("Regressions against the baseline:\n  " + "\n  ".join(found))
+        else:
+            print(f"No regression beyond {args.threshold:.0%} against the baseline")
+    else:
+        failed = True
+        print(f"No baseline at {args.baseline}, run with --save-baseline to make one")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
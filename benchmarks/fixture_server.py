@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+"""Local stand-in for the Rightmove pages the crawlers fetch.
+
+Serves search result pages (/property-to-rent/find.html) and listing pages
+(/properties/<id>) built from the page templates in fixtures/. Every location
+gets the same number of listings, with a price and bedroom count derived from
+the property id, so the search filters (minPrice, maxPrice, minBedrooms,
+maxBedrooms), the result count and the paging behave like the site's:
+
+- full pages have 24 results plus the featured property, 25 cards
+- nothing is listed past `page_cap` results, however many the search has
+
+A share of the listings (`duplicate_rate`) are the same flat listed again
+under a new property id, with a new image and a slightly edited description.
+
+Responses are delayed by `latency` ± `jitter` seconds, a share of them fail
+with a 503 (`error_rate`) or a 429 with Retry-After (`throttle_rate`). Runs
+are reproducible for a given `seed`.
+
+    python -m benchmarks.fixture_server --port 8001 --latency 0.05
+"""
+import argparse
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from string import Template
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = Path(__file__).parent / "fixtures"
+PAGE_SIZE = 24
+LOCATION_STRIDE = 1_000_000
+ADJECTIVES = ("Bright", "Spacious", "Modern", "Refurbished", "Charming", "Quiet")
+FEATURES = (
+    "a garden",
+    "a balcony",
+    "parking",
+    "a roof terrace",
+    "a home office",
+    "a concierge",
+    "a gym",
+    "bills included",
+)
+# How far back the listing a duplicate copies can be
+DUPLICATE_WINDOW = 20
+
+
+@dataclass
+class FixtureConfig:
+    listings_per_location: int = 200
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after: int = 1
+    let_agreed_rate: float = 0.1
+    duplicate_rate: float = 0.1
+    page_cap: int = 1000
+    seed: int = 0
+
+
+def load_template(name: str) -> Template:
+    return Template((FIXTURES / name).read_text())
+
+
+class Listings:
+    """The made-up listings of every location, derived from the property id"""
+
+    def __init__(self, config: FixtureConfig):
+        self.config = config
+
+    def property_id(self, location_id: int, n: int) -> int:
+        return (location_id + 1) * LOCATION_STRIDE + n
+
+    def get(self, property_id: int) -> Optional[Dict]:
+        location_id, n = divmod(property_id, LOCATION_STRIDE)
+        location_id -= 1
+        if location_id < 0 or not 0 <= n < self.config.listings_per_location:
+            return None
+
+        rng = random.Random(property_id * 7919 + self.config.seed)
+        rent = rng.randrange(400, 2500, 25)
+        bedrooms = rng.choice((1, 2, 2, 2, 3, 3, 4, 5, 11))
+        listing = {
+            "property_id": property_id,
+            "location_id": location_id,
+            "location_name": f"Location {location_id}",
+            "rent": rent,
+            "rent_pw": rent * 12 // 52,
+            "deposit": f"{rent * 115 // 100:,}",
+            "bedrooms": bedrooms,
+            "bathrooms": max(1, bedrooms // 2),
+            "size": f"{rng.randrange(350, 1800, 10):,}",
+            "let_available_date": rng.choice(
+                ("Now", "Now", "Ask agent", "01/06/2024", "15/07/2024", "01/09/2024")
+            ),
+            "let_agreed": rng.random() < self.config.let_agreed_rate,
+            "title": f"{bedrooms} bedroom flat for rent",
+            "description": (
+                f"{rng.choice(ADJECTIVES)} {bedrooms} bedroom flat to rent in "
+                f"Location {location_id}, {rng.randrange(2, 20)} minutes from the "
+                f"station, with {rng.choice(FEATURES)} and {rng.choice(FEATURES)}, "
+                "available on a long let."
+            ),
+        }
+        if n > 0 and rng.random() < self.config.duplicate_rate:
+            original = self.get(
+                property_id - 1 - rng.randrange(min(n, DUPLICATE_WINDOW))
+            )
+            listing.update(
+                {k: v for k, v in original.items() if k != "property_id"},
+                description=original["description"] + " Viewings from Monday.",
+            )
+        return listing
+
+    def search(self, location_id: int, query: Dict[str, str]) -> List[Dict]:
+        def bound(name: str, default: int) -> int:
+            return int(query[name]) if query.get(name) else default
+
+        min_price, max_price = bound("minPrice", 0), bound("maxPrice", 10**9)
+        min_bedrooms = bound("minBedrooms", 0)
+        max_bedrooms = bound("maxBedrooms", 10**9)
+        listings = (
+            self.get(self.property_id(location_id, n))
+            for n in range(self.config.listings_per_location)
+        )
+        return [
+            p
+            for p in listings
+            if min_price <= p["rent"] <= max_price
+            and min_bedrooms <= p["bedrooms"] <= max_bedrooms
+            and not (p["let_agreed"] and query.get("includeLetAgreed") == "false")
+        ]
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, as the site serves them
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_page(self, code: int, body: str = "", headers: Dict[str, str] = None):
+        payload = body.encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        server: FixtureServer = self.server.fixture
+        config = server.config
+        with server.lock:
+            delay = max(0.0, server.rng.gauss(config.latency, config.jitter))
+            failure = server.rng.random()
+            server.requests += 1
+        time.sleep(delay)
+
+        if failure < config.throttle_rate:
+            self.send_page(429, headers={"Retry-After": str(config.retry_after)})
+            return
+        if failure < config.throttle_rate + config.error_rate:
+            self.send_page(503)
+            return
+
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if url.path == "/property-to-rent/find.html":
+            self.send_search(server, query)
+        elif url.path.startswith("/properties/"):
+            self.send_listing(server, url.path[len("/properties/") :])
+        else:
+            self.send_page(404)
+
+    def send_search(self, server: "FixtureServer", query: Dict[str, str]):
+        try:
+            location_id = int(query.get("locationIdentifier", "").replace("REGION", ""))
+            index = int(query.get("index", 0))
+        except ValueError:
+            self.send_page(400)
+            return
+
+        results = server.listings.search(location_id, query)
+        visible = results[: server.config.page_cap]
+        page = visible[index : index + PAGE_SIZE]
+        # Full pages come with a featured property on top
+        if len(page) == PAGE_SIZE:
+            page = [visible[0]] + page
+
+        cards = "\n".join(server.card.substitute(p) for p in page)
+        self.send_page(
+            200,
+            server.search.substitute(
+                location_name=f"Location {location_id}",
+                result_count=f"{len(results):,}",
+                cards=cards,
+                page=index // PAGE_SIZE + 1,
+                pages=max(1, -(-len(visible) // PAGE_SIZE)),
+            ),
+        )
+
+    def send_listing(self, server: "FixtureServer", property_id: str):
+        _property = (
+            server.listings.get(int(property_id)) if property_id.isdigit() else None
+        )
+        if _property is None:
+            self.send_page(404)
+            return
+
+        let_agreed = (
+            '<span class="ksc_lozenge berry _2WqVSGdiq2H4orAZsyHHgz">Let agreed</span>'
+            if _property["let_agreed"]
+            else ""
+        )
+        self.send_page(200, server.listing.substitute(_property, let_agreed=let_agreed))
+
+
+class FixtureServer:
+    def __init__(self, config: FixtureConfig, host: str = "127.0.0.1", port: int = 0):
+        self.config = config
+        self.listings = Listings(config)
+        self.search = load_template("search.html")
+        self.card = load_template("search_card.html")
+        self.listing = load_template("listing.html")
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), FixtureHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fixture = self
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> "FixtureServer":
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def add_fixture_arguments(parser: argparse.ArgumentParser):
+    defaults = FixtureConfig()
+    parser.add_argument("--listings", type=int, default=defaults.listings_per_location)
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--jitter", type=float, default=defaults.jitter)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--throttle-rate", type=float, default=defaults.throttle_rate)
+    parser.add_argument("--page-cap", type=int, default=defaults.page_cap)
+    parser.add_argument("--duplicate-rate", type=float, default=defaults.duplicate_rate)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+
+
+def fixture_config(args: argparse.Namespace) -> FixtureConfig:
+    return FixtureConfig(
+        listings_per_location=args.listings,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        throttle_rate=args.throttle_rate,
+        page_cap=args.page_cap,
+        duplicate_rate=args.duplicate_rate,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    add_fixture_arguments(parser)
+    args = parser.parse_args()
+
+    server = FixtureServer(fixture_config(args), args.host, args.port)
+    print(f"Serving fixtures on {server.url}")
+    server.httpd.serve_forever()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""End-to-end throughput benchmark of the crawl tasks.
+
+Runs extract_property_links and then extract_property_details against the
+fixture server, with the crawler parameters from project.yaml and the
+warehouse replaced by an in-memory one. For each task it reports pages/sec,
+records/sec, the p50/p99 fetch latency and the peak RSS, and compares them to
+a baseline saved with --save-baseline. The run fails when a figure is worse
+than the baseline by more than --tolerance.
+
+    python -m benchmarks.run_crawl --locations 10 --latency 0.05
+    python -m benchmarks.run_crawl --parser selectolax --save-baseline
+
+Latencies come from the task's fetch histogram, so they are bucket bounds. The
+fixture server runs in the same process as the tasks: the figures are meant to
+be compared between runs on the same machine, not as absolute numbers.
+"""
+import argparse
+import json
+import re
+import resource
+import sys
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Mapping
+
+import yaml
+
+from python.extract_properties import extract_property_links
+from python.extract_property_details import extract_property_details
+
+from .fixture_server import FixtureServer, add_fixture_arguments, fixture_config
+
+PROJECT = Path(__file__).parent.parent / "project.yaml"
+BASELINE = Path(__file__).parent / "baseline.json"
+
+# Figures compared to the baseline and whether higher is better
+FIGURES = {
+    "pages_per_sec": True,
+    "records_per_sec": True,
+    "fetch_p50": False,
+    "fetch_p99": False,
+    "peak_rss_mb": False,
+}
+
+
+class MemoryWarehouse:
+    """The part of sayn's Database the crawl tasks use, kept in memory"""
+
+    db_type = "memory"
+
+    def __init__(self):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {}
+
+    def load_data(
+        self, table: str, data, schema: str = None, replace: bool = False, **ddl
+    ):
+        name = f"{schema}.{table}" if schema else table
+        if replace or name not in self.tables:
+            self.tables[name] = []
+        self.tables[name].extend(dict(row) for row in data)
+
+    def read_data(self, query: str) -> List[Dict[str, Any]]:
+        name = next(
+            t for t in re.findall(r"FROM\s+`?([\w.]+)", query) if t in self.tables
+        )
+        rows = self.tables[name]
+        if "ROW_NUMBER" in query:
+            # Latest row of each property, as in the details query
+            rows = list({row["property_id"]: row for row in rows}.values())
+        return rows
+
+    def create_table(
+        self, table: str, schema: str = None, replace: bool = False, **ddl
+    ) -> str:
+        # Tables are created here, there's no statement to execute
+        name = f"{schema}.{table}" if schema else table
+        if replace or name not in self.tables:
+            self.tables[name] = []
+        return ""
+
+    def execute(self, query: str):
+        pass
+
+
+class BenchmarkContext:
+    """The part of sayn's task context the crawl tasks use"""
+
+    def __init__(self, schema_prefix: str, verbose: bool = False):
+        self.schema_prefix = schema_prefix
+        self.verbose = verbose
+        self.run_arguments = {"full_load": False}
+
+    def src(self, name: str) -> str:
+        schema, table = name.split(".")
+        return f"{self.schema_prefix}_{schema}.{table}"
+
+    out = src
+
+    def info(self, message):
+        if self.verbose:
+            print(message, file=sys.stderr)
+
+    def set_run_steps(self, steps):
+        pass
+
+    def start_step(self, step):
+        pass
+
+    def finish_current_step(self):
+        pass
+
+    @contextmanager
+    def step(self, name):
+        yield
+
+    def success(self):
+        pass
+
+
+def peak_rss_mb() -> float:
+    """Peak RSS of this process plus the largest child (the parse workers)"""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return round((own + children) / scale, 1)
+
+
+def run_task(task, metrics_dir: Path, **kwargs) -> Dict[str, Any]:
+    # The function the sayn decorator wrapped
+    function = task.func
+    function(metrics={"directory": str(metrics_dir)}, **kwargs)
+    report = json.loads(
+        max(metrics_dir.glob(f"{function.__name__}-*.json")).read_text()
+    )
+
+    counters, fetch = report["counters"], report["stages"].get("fetch", {})
+    return {
+        "pages_per_sec": report["per_second"].get("pages", 0),
+        "records_per_sec": report["per_second"].get("records", 0),
+        "fetch_p50": fetch.get("p50"),
+        "fetch_p99": fetch.get("p99"),
+        "peak_rss_mb": peak_rss_mb(),
+        "pages": counters.get("pages", 0),
+        "records": counters.get("records", 0),
+        "failed": counters.get("failed", 0),
+        "duplicates": counters.get("duplicates", 0),
+        "duration": report["duration"],
+    }
+
+
+def compare(
+    results: Mapping[str, Mapping[str, Any]],
+    baseline: Mapping[str, Mapping[str, Any]],
+    tolerance: float,
+) -> List[str]:
+    regressions = []
+    for task_name, figures in results.items():
+        for figure, higher_is_better in FIGURES.items():
+            value = figures.get(figure)
+            base = baseline.get(task_name, {}).get(figure)
+            if value is None or not base:
+                continue
+            change = (value - base) / base
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    f"{task_name} {figure}: {value} vs {base} in the baseline"
+                    f" ({change:+.0%})"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--locations", type=int, default=5)
+    parser.add_argument("--mode", choices=("async", "sync"))
+    parser.add_argument("--parser", dest="page_parser")
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1000,
+        help="Scheduler requests/sec per host, well above the project's so the "
+        "crawler is measured rather than the rate limit",
+    )
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--verbose", action="store_true")
+    add_fixture_arguments(parser)
+    args = parser.parse_args()
+
+    project = yaml.safe_load(PROJECT.read_text())
+    tmp = Path(tempfile.mkdtemp(prefix="rightmove-bench-"))
+    crawler = dict(project["parameters"]["crawler"])
+    crawler.update(
+        incremental=False,
+        shard_count=1,
+        shard_index=0,
+        cache={"mode": "off"},
+        checkpoint_dir=str(tmp / "checkpoints"),
+        scheduler=dict(
+            crawler.get("scheduler") or {}, rate=args.rate, burst=max(args.rate, 1)
+        ),
+    )
+    if args.mode:
+        crawler["mode"] = args.mode
+    if args.page_parser:
+        crawler["parser"] = args.page_parser
+
+    warehouse = MemoryWarehouse()
+    context = BenchmarkContext(project["schema_prefix"], args.verbose)
+    warehouse.load_data(
+        "rightmove_locations",
+        [
+            {"location_id": i, "location_name": f"Location {i}"}
+            for i in range(args.locations)
+        ],
+        schema=f"{project['schema_prefix']}_raw",
+    )
+
+    results = {}
+    with FixtureServer(fixture_config(args)) as server:
+        crawler["base_url"] = server.url
+        for task in (extract_property_links, extract_property_details):
+            results[task.func.__name__] = run_task(
+                task,
+                tmp / "metrics",
+                context=context,
+                warehouse=warehouse,
+                crawler=crawler,
+            )
+
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Saved the baseline to {args.baseline}")
+    elif args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+        if regressions := compare(results, baseline, args.tolerance):
+            print("Regressions against the baseline:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print(f"No regression beyond {args.tolerance:.0%} against the baseline")
+    else:
+        print(f"No baseline at {args.baseline}, run with --save-baseline to make one")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""Chunked loads with a resumable journal for the crawl tasks.
+
+Records are loaded to the warehouse every `chunk_size` records. Once a chunk
+is loaded, the keys of the work it covers (locations, pages, property ids) are
+appended to a journal file and synced to disk. A rerun of the task for the same
+run id reads the journal back, skips the work already done and appends to the
+table instead of replacing it. The journal is removed when the task finishes.
+
+The journal is a local file, so only a rerun on the same machine resumes: a
+Cloud Run task that times out loses it with its container, and the rerun
+starts the crawl over.
+
+Crawls running in an event loop add records with `aadd`, the chunks are then
+loaded in a thread of the loader so the crawl goes on during the load.
+"""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional
+
+from sayn.database import Database
+
+from .metrics import Metrics
+
+# Column types are given with their BigQuery names, sqlite gets the affinity
+# that keeps the values as they are (a STRING column would turn "0123" into 123)
+SQLITE_TYPES = {"STRING": "TEXT", "FLOAT64": "REAL", "INT64": "INTEGER"}
+
+
+def table_ddl(warehouse: Database, columns: Mapping[str, str]) -> Dict[str, Any]:
+    """The `columns` ddl of `Database.load_data` for a warehouse"""
+    if getattr(warehouse, "db_type", None) == "sqlite":
+        columns = {name: SQLITE_TYPES.get(t, t) for name, t in columns.items()}
+    return {"columns": [{"name": name, "type": t} for name, t in columns.items()]}
+
+
+def add_columns_query(table: str, columns: Mapping[str, str]) -> str:
+    """Add the columns a table created by an earlier version doesn't have yet"""
+    added = ", ".join(
+        f"ADD COLUMN IF NOT EXISTS {name} {_type}" for name, _type in columns.items()
+    )
+    return f"ALTER TABLE IF EXISTS {table} {added}"
+
+
+class Checkpoint:
+    def __init__(self, directory: str, name: str, run_id: str):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self.path = Path(directory) / f"{name}.jsonl"
+        self.run_id = run_id
+        self.done = set()
+
+        if self.path.exists():
+            with self.path.open() as f:
+                header = json.loads(f.readline() or "{}")
+                if header.get("run_id") == run_id:
+                    for line in f:
+                        try:
+                            self.done.update(json.loads(line))
+                        except ValueError:
+                            # A line cut short by the crash that stopped the run
+                            break
+
+        # Only resumed if something was loaded by a previous attempt
+        self.resumed = len(self.done) > 0
+        if not self.resumed:
+            with self.path.open("w") as f:
+                f.write(json.dumps({"run_id": run_id}) + "\n")
+
+    def is_done(self, key: str) -> bool:
+        return key in self.done
+
+    def record(self, keys: Iterable[str]):
+        keys = list(keys)
+        if not keys:
+            return
+        with self.path.open("a") as f:
+            f.write(json.dumps(keys) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.done.update(keys)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+
+
+class ChunkedLoader:
+    def __init__(
+        self,
+        warehouse: Database,
+        table: str,
+        schema: str,
+        checkpoint: Checkpoint,
+        chunk_size: int = 500,
+        replace: bool = False,
+        on_flush: Optional[Callable[[], None]] = None,
+        metrics: Optional[Metrics] = None,
+        prepare: Optional[Callable[[List[Mapping[str, Any]]], Any]] = None,
+        columns: Optional[Mapping[str, str]] = None,
+    ):
+        self.warehouse = warehouse
+        self.table = table
+        self.schema = schema
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        if replace and not columns:
+            raise ValueError(f"Replacing {table} needs its columns")
+        # A resumed run appends to what the previous attempt loaded
+        self.replace = replace and not checkpoint.resumed
+        self.on_flush = on_flush
+        self.metrics = metrics
+        # Turns a chunk into what's loaded, eg: a RecordBatch of typed records
+        self.prepare = prepare
+        # The table is created from these columns rather than from the Python
+        # types of the first record, which don't say what type a None is
+        self.ddl = table_ddl(warehouse, columns) if columns else {}
+        self.records: List[Mapping[str, Any]] = []
+        self.keys: List[str] = []
+        self.n_loaded = 0
+        # One thread, so chunks are loaded one at a time and in order
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def add(self, records: Iterable[Mapping[str, Any]], keys: Iterable[str] = ()):
+        """Buffer records along with the keys of the work that produced them"""
+        self.records.extend(records)
+        self.keys.extend(keys)
+        if len(self.records) >= self.chunk_size:
+            self.flush()
+
+    async def aadd(
+        self, records: Iterable[Mapping[str, Any]], keys: Iterable[str] = ()
+    ):
+        """`add` for an event loop, a full chunk is loaded in the loader thread"""
+        self.records.extend(records)
+        self.keys.extend(keys)
+        if len(self.records) >= self.chunk_size:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(1, thread_name_prefix="loader")
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._load, *self._take()
+            )
+
+    def _take(self):
+        # Records added while a chunk loads go to the next one
+        taken = self.records, self.keys
+        self.records, self.keys = [], []
+        return taken
+
+    def flush(self):
+        self._load(*self._take())
+
+    def _load(self, records: List[Mapping[str, Any]], keys: List[str]):
+        if records:
+            if self.prepare is not None:
+                records = self.prepare(records)
+            start = time.perf_counter()
+            self.warehouse.load_data(
+                self.table,
+                records,
+                schema=self.schema,
+                replace=self.replace,
+                **self.ddl,
+            )
+            if self.metrics is not None:
+                self.metrics.observe("load", time.perf_counter() - start)
+                self.metrics.count("records_loaded", len(records))
+            self.n_loaded += len(records)
+            self.replace = False
+        self.checkpoint.record(keys)
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def close(self):
+        """Load what's left and drop the journal"""
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.flush()
+        if self.replace:
+            # Nothing was found. load_data doesn't touch the table without
+            # records, it's replaced by an empty one
+            self.warehouse.execute(
+                self.warehouse.create_table(
+                    self.table, schema=self.schema, replace=True, **self.ddl
+                )
+            )
+        self.checkpoint.clear()
@@ -0,0 +1,183 @@
+"""Near-duplicate listings, found with MinHash signatures and LSH.
+
+The same flat is often listed again under a new property_id, or by several
+agents. Each listing is turned into a set of shingles: the word 3-grams of its
+title and description, its rent and its image url. The MinHash signatures of
+two sets agree on about as many positions as the Jaccard similarity of the
+sets. Signatures are cut in `bands` and listings sharing a band become
+candidates; only candidates are compared, so the work grows with the number of
+listings rather than the number of pairs.
+
+Candidates agreeing on at least `threshold` of their signature join the same
+cluster, unless both have a rent and the rents are more than `rent_tolerance`
+apart. A cluster is named after its oldest listing, the lowest property_id, so
+its id stays the same from one run to the next until clusters merge.
+"""
+import re
+import zlib
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Set
+
+import numpy as np
+
+WORD = re.compile(r"[a-z0-9]+")
+SHINGLE_SIZE = 3
+NUMBER = re.compile(r"\d[\d,]*")
+# Thumbnails of the same image only differ by their size suffix
+IMAGE_SIZE = re.compile(r"_max_\d+x\d+")
+MAX_HASH = np.uint64((1 << 32) - 1)
+# Listings hashed at a time, bounds the (shingles, num_perm) matrix
+CHUNK_SIZE = 500
+# Bigger buckets (templated cards) are only compared to their first listing
+MAX_BUCKET = 50
+
+
+def to_rent(value: Any) -> Optional[int]:
+    if isinstance(value, (int, np.integer)):
+        return int(value)
+    if match := NUMBER.search(str(value or "")):
+        return int(match.group().replace(",", ""))
+    return None
+
+
+def shingles(listing: Mapping[str, Any]) -> Set[str]:
+    text = f"{listing.get('title') or ''} {listing.get('description') or ''}"
+    found = set()
+    if words := WORD.findall(text.lower()):
+        # Texts shorter than a shingle are a shingle of their own
+        for i in range(max(1, len(words) - SHINGLE_SIZE + 1)):
+            found.add(" ".join(words[i : i + SHINGLE_SIZE]))
+    if (rent := to_rent(listing.get("rent_pcm"))) is not None:
+        found.add(f"rent:{rent}")
+    if image := listing.get("image"):
+        found.add(f"image:{IMAGE_SIZE.sub('', image.split('?')[0])}")
+    return found
+
+
+def id_order(property_id: str):
+    # Property ids are numbers given out in order, compare them as numbers
+    return len(property_id), property_id
+
+
+class NearDuplicates:
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        num_perm: int = 128,
+        bands: int = 16,
+        rent_tolerance: float = 0.1,
+        seed: int = 1,
+    ):
+        if num_perm % bands:
+            raise ValueError(f"num_perm {num_perm} isn't a multiple of bands {bands}")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.rent_tolerance = rent_tolerance
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: the high 32 bits of a * x + b, a odd
+        self.a = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64) * 2 + 1
+        self.b = rng.integers(0, 1 << 63, size=num_perm, dtype=np.uint64)
+
+    @classmethod
+    def from_config(
+        cls, config: Optional[Mapping[str, Any]]
+    ) -> Optional["NearDuplicates"]:
+        """Build from the crawler `dedup` parameter, None when it's disabled"""
+        config = dict(config or {})
+        if not config.pop("enabled", True):
+            return None
+        return cls(**config)
+
+    def signatures(self, sets: Sequence[Set[str]]) -> np.ndarray:
+        """MinHash signature of each set, all MAX_HASH for an empty set"""
+        signatures = np.full((len(sets), self.num_perm), MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(sets), CHUNK_SIZE):
+            chunk = sets[start : start + CHUNK_SIZE]
+            sizes = np.fromiter(map(len, chunk), dtype=np.int64, count=len(chunk))
+            if not sizes.any():
+                continue
+            hashes = np.fromiter(
+                (zlib.crc32(s.encode()) for shingles in chunk for s in shingles),
+                dtype=np.uint64,
+                count=int(sizes.sum()),
+            )
+            # The products wrap around at 64 bits, as the scheme expects. One row
+            # per permutation, so the minimum of each set is over contiguous
+            # memory.
+            permuted = (self.a[:, None] * hashes + self.b[:, None]) >> np.uint64(32)
+            filled = np.flatnonzero(sizes)
+            offsets = (np.cumsum(sizes) - sizes)[filled]
+            signatures[start + filled] = np.minimum.reduceat(
+                permuted, offsets, axis=1
+            ).T
+        return signatures
+
+    def buckets(self, signatures: np.ndarray, listings: np.ndarray):
+        """Yield the listings sharing a band of their signature, band by band"""
+        for band in range(self.bands):
+            keys = signatures[listings, band * self.rows : (band + 1) * self.rows]
+            order = np.lexsort(keys.T[::-1])
+            keys = keys[order]
+            changed = np.any(keys[1:] != keys[:-1], axis=1)
+            starts = np.flatnonzero(np.concatenate(([True], changed)))
+            sizes = np.diff(np.append(starts, len(order)))
+            for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+                yield listings[order[start : start + size]]
+
+    def rents_match(self, a: Optional[int], b: Optional[int]) -> bool:
+        if a is None or b is None:
+            return True
+        return abs(a - b) <= self.rent_tolerance * max(a, b)
+
+    def clusters(self, listings: Sequence[Mapping[str, Any]]) -> List[str]:
+        """Cluster id of each listing, its own property_id when it has no duplicate"""
+        signatures = self.signatures([shingles(l) for l in listings])
+        rents = [to_rent(l.get("rent_pcm")) for l in listings]
+        parent = list(range(len(listings)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # Listings without any shingle would all share every band
+        hashed = np.flatnonzero(signatures[:, 0] != MAX_HASH)
+        for members in self.buckets(signatures, hashed):
+            anchors = members if len(members) <= MAX_BUCKET else members[:1]
+            for k, i in enumerate(anchors):
+                others = members[k + 1 :]
+                agreement = (signatures[others] == signatures[i]).mean(axis=1)
+                for j in others[agreement >= self.threshold]:
+                    if find(i) != find(j) and self.rents_match(rents[i], rents[j]):
+                        parent[find(j)] = find(i)
+
+        names: Dict[int, str] = {}
+        for i, listing in enumerate(listings):
+            root = find(i)
+            property_id = str(listing["property_id"])
+            if root not in names or id_order(property_id) < id_order(names[root]):
+                names[root] = property_id
+        return [names[find(i)] for i in range(len(listings))]
+
+
+def latest_of_clusters(
+    listings: Sequence[Mapping[str, Any]], cluster_ids: Sequence[str]
+) -> List[int]:
+    """Index of the latest listing of each cluster, the one still advertised.
+
+    Listings crawled the same day are told apart by their property_id, the
+    newer listing having the higher id.
+    """
+
+    def recency(listing: Mapping[str, Any]):
+        return listing["date_added"], id_order(str(listing["property_id"]))
+
+    latest: Dict[str, int] = {}
+    for i, cluster_id in enumerate(cluster_ids):
+        if (j := latest.get(cluster_id)) is None or recency(listings[i]) > recency(
+            listings[j]
+        ):
+            latest[cluster_id] = i
+    return sorted(latest.values())
@@ -1,4 +1,6 @@
-from typing import Mapping
+import math
+from datetime import datetime
+from typing import Any, Mapping
 from google.oauth2 import service_account
 import google.auth
 from googleapiclient.discovery import build
@@ -6,15 +8,25 @@ from sayn import task
 from sayn.tasks.task import Task
 from sayn.database import Database
 import pygsheets as gs
+from pygsheets import DateTimeRenderOption, ValueRenderOption
 import pandas as pd
 
+from .metrics import Metrics
+
+# Kept as first exported on rows already in the sheet
+KEPT_COLUMNS = ("date_added",)
+# Dates as the sheet shows them (en-GB) and as they're entered
+DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d/%m/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S")
+
 
 @task(sources="raw.property_details")
 def extract_gsheet(
     context: Task,
     warehouse: Database,
     gsheets: Mapping[str, Mapping[str, Mapping[str, str]]],
+    metrics: Mapping[str, Any],
 ):
+    run_metrics = Metrics("extract_gsheet")
     with context.step("Config"):
         if not (service_account_info := gsheets.get("service_account")):
             credentials, _ = google.auth.default(
@@ -28,7 +40,8 @@ def extract_gsheet(
 
     with context.step("Get data"):
         src_table = context.src("intermediate.property_details")
-        values = warehouse.read_data(f"SELECT * FROM {src_table}")
+        with run_metrics.timer("read"):
+            values = warehouse.read_data(f"SELECT * FROM {src_table}")
         df_new = pd.DataFrame(values).drop_duplicates(subset="property_id")
 
     with context.step("Get Gsheets data"):
@@ -40,12 +53,107 @@ def extract_gsheet(
 
         wks = sh[1]
 
-        df_old = wks.get_as_df()
+        with run_metrics.timer("read_sheet"):
+            # Numbers as numbers whatever format the sheet shows them in, dates
+            # as shown (eg: "01/07/2024"), the way they were entered
+            rows = wks.get_all_values(
+                include_tailing_empty=False,
+                include_tailing_empty_rows=False,
+                value_render=ValueRenderOption.UNFORMATTED_VALUE,
+                date_time_render_option=DateTimeRenderOption.FORMATTED_STRING,
+            )
+
+    with context.step("Update Gsheets"):
+        if not rows or not rows[0]:
+            with run_metrics.timer("write_sheet"):
+                wks.set_dataframe(df_new, (1, 1))
+            run_metrics.count("rows_appended", len(df_new))
+            context.info(f"Run report: {run_metrics.write(metrics)}")
+            return context.success()
+
+        header = [str(c) for c in rows[0]]
+        new_columns = [c for c in df_new.columns if c not in header]
+        if new_columns:
+            header = header + new_columns
+            wks.update_values("A1", [header])
+
+        id_col = header.index("property_id")
+        sheet_rows = {
+            normalize_cell(row[id_col]): (n, row)
+            for n, row in enumerate(rows[1:], start=2)
+            if len(row) > id_col
+        }
+
+        appended = []
+        ranges, values = [], []
+        for record in df_new.to_dict("records"):
+            new_row = [to_cell(record.get(c, "")) for c in header]
+            if (found := sheet_rows.get(normalize_cell(new_row[id_col]))) is None:
+                appended.append(new_row)
+                continue
+
+            n, old_row = found
+            for col, value in enumerate(new_row):
+                if header[col] in KEPT_COLUMNS:
+                    continue
+                old_value = old_row[col] if col < len(old_row) else ""
+                if normalize_cell(value) != normalize_cell(old_value):
+                    ranges.append(cell_label(n, col + 1))
+                    values.append([[value]])
+
+        # One call for every changed cell, one for the new rows
+        with run_metrics.timer("write_sheet"):
+            if ranges:
+                wks.update_values_batch(ranges, values)
+            if appended:
+                wks.append_table(appended, start="A1", overwrite=False)
+
+        run_metrics.count("rows_appended", len(appended))
+        run_metrics.count("cells_updated", len(ranges))
+        context.info(f"Run report: {run_metrics.write(metrics)}")
+
+
+def to_cell(value) -> str:
+    """Format a value the way the sheet displays it back"""
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def normalize_cell(value) -> str:
+    """A cell value as the sheet keeps it, to compare what's written and read.
 
-        df_final = pd.concat([df_old, df_new], ignore_index=True).drop_duplicates(
-            subset="property_id"
-        )
+    Written values are parsed by the sheet (eg: "1,500" becomes the number
+    1500, "True" a boolean) and read back unformatted, dates as shown.
+    """
+    if hasattr(value, "item"):
+        # numpy scalars
+        value = value.item()
+    if isinstance(value, bool):
+        return str(value).upper()
+    if isinstance(value, str):
+        if value.upper() in ("TRUE", "FALSE"):
+            return value.upper()
+        for date_format in DATE_FORMATS:
+            try:
+                return datetime.strptime(value.strip(), date_format).isoformat()
+            except ValueError:
+                pass
+        try:
+            value = float(value.replace(",", ""))
+        except ValueError:
+            return value
+    if isinstance(value, (int, float)):
+        return to_cell(float(value))
+    return to_cell(value)
 
-        wks.clear()
 
-        wks.set_dataframe(df_final, (1, 1))
+def cell_label(row: int, col: int) -> str:
+    """A1 notation of a cell from 1-based row and column numbers"""
+    letters = ""
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return f"{letters}{row}"
@@ -1,92 +1,403 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
 from sayn import task
 from sayn.tasks.task import Task
 from sayn.database import Database
 from datetime import datetime
-from bs4 import BeautifulSoup
 import httpx
-import re
+
+from .checkpoint import Checkpoint, ChunkedLoader, add_columns_query
+from .http_client import make_client
+from .metrics import Metrics
+from .parsers import get_parser
+from .scheduler import RequestScheduler
+from .sharding import in_shard, shard_config, shard_table
 
 BASE_URL = "https://www.rightmove.co.uk/"
+PAGE_SIZE = 24
+MAX_BEDROOMS = 10
+# Prices the site offers in its rent search filters
+# fmt: off
+PRICE_LADDER = (
+    100, 150, 200, 250, 300, 350, 400, 450, 500, 600, 700, 800, 900, 1000,
+    1100, 1200, 1250, 1300, 1400, 1500, 1600, 1750, 1800, 1900, 2000, 2250, 2500,
+)
+# fmt: on
 
+# Columns of raw.property_links, the cards of parse_search_page
+LINK_COLUMNS = {
+    "property_id": "STRING",
+    "property_url": "STRING",
+    "image": "STRING",
+    "title": "STRING",
+    "description": "STRING",
+    "rent_pcm": "STRING",
+    "location_id": "STRING",
+    "location_name": "STRING",
+    "date_added": "TIMESTAMP",
+}
 
-@task(sources="raw.rightmove_locations", outputs="raw.property_links")
-def extract_property_links(context: Task, warehouse: Database):
-    src_table = context.src("raw.rightmove_locations")
-    locations = warehouse.read_data(f"SELECT * FROM {src_table}")
+# (min price, max price, min bedrooms, max bedrooms), 0 or None for no limit
+Band = Tuple[int, int, int, Optional[int]]
 
-    property_links = []
-    today = datetime.now()
-    context.set_run_steps(
-        [f"Get Property Links for {loc['location_name']}" for loc in locations]
-    )
+params = {
+    "searchType": "RENT",
+    "maxPrice": 2500,
+    "minBedrooms": 2,
+    "includeLetAgreed": "false",
+}
+
+
+def parse_search_page(
+    html: str, location: Mapping[str, Any], today: datetime, parser: str
+):
+    """Extract the property cards and the result count of a search results page"""
+    cards, count = get_parser(parser).parse_search_page(html)
+    cards = [
+        dict(
+            card,
+            location_id=location["location_id"],
+            location_name=location["location_name"],
+            date_added=today,
+        )
+        for card in cards
+    ]
+    return cards, count
+
+
+def timed_parse_search_page(
+    html: str, location: Mapping[str, Any], today: datetime, parser: str
+):
+    """parse_search_page for the parse workers, returns the time spent parsing too"""
+    start = time.perf_counter()
+    page = parse_search_page(html, location, today, parser)
+    return page, time.perf_counter() - start
+
+
+def page_key(
+    location: Mapping[str, Any], index: int, band: Optional[Band] = None
+) -> str:
+    if band is None:
+        return f"{location['location_id']}:{index}"
+    return f"{location['location_id']}:{'-'.join(map(str, band))}:{index}"
+
+
+def location_key(location: Mapping[str, Any]) -> str:
+    return str(location["location_id"])
 
-    params = {
-        "searchType": "RENT",
-        "maxPrice": 2500,
-        "minBedrooms": 2,
-        "includeLetAgreed": "false",
-    }
 
-    with httpx.Client(base_url=BASE_URL, params=params) as client:
+def crawl_sync(
+    context: Task,
+    client: httpx.Client,
+    locations,
+    today: datetime,
+    parser: str,
+    loader: ChunkedLoader,
+    scheduler: RequestScheduler,
+    metrics: Metrics,
+):
+    with client:
         for location in locations:
             index = 0
+            region = f"REGION{location['location_id']}"
             context.start_step(f"Get Property Links for {location['location_name']}")
             page = True
             while page:
+                if loader.checkpoint.is_done(page_key(location, index)):
+                    index += PAGE_SIZE
+                    continue
+
                 try:
-                    response = client.get(
+                    response = scheduler.send(
+                        client,
                         "property-to-rent/find.html",
-                        params={
-                            "locationIdentifier": f"REGION{location['location_id']}",
-                            "index": index,
-                        },
+                        params={"locationIdentifier": region, "index": index},
                     )
+                    metrics.observe("fetch", response.elapsed.total_seconds())
+                    metrics.count("pages")
+                    metrics.count("bytes", len(response.content))
                     response.raise_for_status()
 
                 except Exception as e:
+                    # Retries are done by the scheduler, give up on the location
                     context.info(e)
-                    continue
-                soup = BeautifulSoup(response.text, "html.parser")
+                    break
 
-                properties = soup.find_all(
-                    "div",
-                    id=re.compile(r"property-[1-9]\d+"),
-                    class_=["l-searchResult", "is-list"],
-                )
-                if not properties or len(properties) < 25:
+                with metrics.timer("parse"):
+                    cards, _ = parse_search_page(response.text, location, today, parser)
+                metrics.count("records", len(cards))
+                if len(cards) < 25:
                     page = False
+                    loader.add(
+                        cards, [page_key(location, index), location_key(location)]
+                    )
+                else:
+                    loader.add(cards, [page_key(location, index)])
+
+                index += PAGE_SIZE
+            context.finish_current_step()
+
+
+def split_band(band: Band) -> Optional[List[Band]]:
+    """Split a search band in two, on price first then on bedrooms.
+
+    Price bands share their boundary price (the site's min and max prices are
+    inclusive), the duplicates are dropped when merging.
+    """
+    min_price, max_price, min_bedrooms, max_bedrooms = band
+    if inner := [p for p in PRICE_LADDER if min_price < p < max_price]:
+        mid = inner[len(inner) // 2]
+        return [
+            (min_price, mid, min_bedrooms, max_bedrooms),
+            (mid, max_price, min_bedrooms, max_bedrooms),
+        ]
+
+    top = max_bedrooms if max_bedrooms is not None else MAX_BEDROOMS
+    if min_bedrooms < top:
+        mid = (min_bedrooms + top) // 2
+        return [
+            (min_price, max_price, min_bedrooms, mid),
+            (min_price, max_price, mid + 1, max_bedrooms),
+        ]
+
+    return None
+
+
+def band_params(band: Band) -> Dict[str, int]:
+    names = ("minPrice", "maxPrice", "minBedrooms", "maxBedrooms")
+    return {k: v for k, v in zip(names, band) if v}
+
+
+async def crawl_location(
+    client: httpx.AsyncClient,
+    scheduler: RequestScheduler,
+    location: Mapping[str, Any],
+    per_location: int,
+    today: datetime,
+    parser: str,
+    loader: ChunkedLoader,
+    max_results: int,
+    metrics: Metrics,
+    pool: Executor,
+):
+    """Crawl the result pages of a location.
+
+    The search is split into price and bedroom bands until each band has no
+    more than `max_results` results, the most the site will page through. Bands
+    are crawled concurrently with up to `per_location` pages in flight for the
+    location, and their cards merged on property_id.
+
+    Within a band pages are requested in windows; the walk stops at the first
+    page with fewer than 25 results (the pages after it are discarded). Pages
+    loaded by a previous attempt of the run are skipped. Pages are parsed in
+    `pool`, off the event loop.
+    """
+    semaphore = asyncio.Semaphore(per_location)
+    seen = set()
+    errors = []
+
+    async def get_page(band: Band, index: int):
+        async with semaphore:
+            response = await scheduler.asend(
+                client,
+                "property-to-rent/find.html",
+                params={
+                    "locationIdentifier": f"REGION{location['location_id']}",
+                    "index": index,
+                    **band_params(band),
+                },
+            )
+        # The last attempt only, the scheduler reports its waits
+        metrics.observe("fetch", response.elapsed.total_seconds())
+        metrics.count("pages")
+        metrics.count("bytes", len(response.content))
+        response.raise_for_status()
+        page, seconds = await asyncio.get_running_loop().run_in_executor(
+            pool, timed_parse_search_page, response.text, location, today, parser
+        )
+        metrics.observe("parse", seconds)
+        return page
+
+    async def add_page(band: Band, index: int, cards: List[Dict[str, Any]]) -> bool:
+        """Load the new cards of a page, returning whether it's the last one"""
+        key = page_key(location, index, band)
+        if not loader.checkpoint.is_done(key):
+            new_cards = [c for c in cards if c["property_id"] not in seen]
+            metrics.count("records", len(new_cards))
+            seen.update(c["property_id"] for c in new_cards)
+            await loader.aadd(new_cards, [key])
+        return len(cards) < 25
+
+    async def crawl_band(band: Band):
+        # The first page is always fetched, it has the band's result count
+        cards, count = await get_page(band, 0)
+        if count is not None and count > max_results and (bands := split_band(band)):
+            await asyncio.gather(*(crawl_band(b) for b in bands))
+            return
+
+        if await add_page(band, 0, cards):
+            return
+
+        index = PAGE_SIZE
+        while True:
+            indexes = [
+                index + PAGE_SIZE * i
+                for i in range(per_location)
+                if not loader.checkpoint.is_done(
+                    page_key(location, index + PAGE_SIZE * i, band)
+                )
+            ]
+            pages = await asyncio.gather(*(get_page(band, i) for i in indexes))
+            for page_index, (cards, _) in zip(indexes, pages):
+                if await add_page(band, page_index, cards):
+                    return
+            index += PAGE_SIZE * per_location
+
+    try:
+        await crawl_band((0, params["maxPrice"], params["minBedrooms"], None))
+    except Exception as e:
+        # Retries are done by the scheduler, give up on the location
+        errors.append(e)
+    else:
+        await loader.aadd([], [location_key(location)])
+
+    return location, errors
+
+
+async def crawl_async(
+    context: Task,
+    client: httpx.AsyncClient,
+    locations,
+    today: datetime,
+    max_connections_per_location: int,
+    parser: str,
+    loader: ChunkedLoader,
+    scheduler: RequestScheduler,
+    max_results: int,
+    metrics: Metrics,
+    pool: Executor,
+):
+    async with client:
+        jobs = [
+            crawl_location(
+                client,
+                scheduler,
+                location,
+                max_connections_per_location,
+                today,
+                parser,
+                loader,
+                max_results,
+                metrics,
+                pool,
+            )
+            for location in locations
+        ]
+        # Steps are reported as each location finishes
+        for job in asyncio.as_completed(jobs):
+            location, errors = await job
+            context.start_step(f"Get Property Links for {location['location_name']}")
+            for e in errors:
+                context.info(e)
+            context.finish_current_step()
+
+
+# With a single shard the links go straight to raw.property_links, otherwise
+# merge_property_links combines the shards into it
+@task(sources="raw.rightmove_locations", outputs="raw.property_link_shards")
+def extract_property_links(
+    context: Task,
+    warehouse: Database,
+    crawler: Mapping[str, Any],
+    metrics: Mapping[str, Any],
+):
+    run_metrics = Metrics("extract_property_links")
+    src_table = context.src("raw.rightmove_locations")
+    locations = warehouse.read_data(f"SELECT * FROM {src_table}")
+
+    shard_index, shard_count = shard_config(crawler)
+    locations = [
+        l for l in locations if in_shard(l["location_id"], shard_index, shard_count)
+    ]
+    table = shard_table("property_links", shard_index, shard_count)
+    if shard_count == 1:
+        # Cards are appended, the table needs their new columns (eg: rent_pcm)
+        warehouse.execute(add_columns_query(f"rightmove_raw.{table}", LINK_COLUMNS))
+
+    today = datetime.now()
+    checkpoint = Checkpoint(
+        crawler.get("checkpoint_dir", ".cache/checkpoints"),
+        table,
+        run_id=today.strftime("%Y-%m-%d"),
+    )
+    # raw.property_links keeps every crawl, shard staging tables only this one
+    loader = ChunkedLoader(
+        warehouse,
+        table,
+        "rightmove_raw",
+        checkpoint,
+        chunk_size=int(crawler.get("chunk_size", 500)),
+        replace=shard_count > 1,
+        metrics=run_metrics,
+        columns=LINK_COLUMNS,
+    )
+    if checkpoint.resumed:
+        locations = [l for l in locations if not checkpoint.is_done(location_key(l))]
+        context.info(f"Resuming the run, {len(locations)} locations left")
+
+    context.set_run_steps(
+        [f"Get Property Links for {loc['location_name']}" for loc in locations]
+    )
+
+    parser = crawler.get("parser", "bs4")
+    max_connections = int(crawler.get("max_connections", 16))
+    scheduler = RequestScheduler.from_config(
+        crawler.get("scheduler"),
+        max_concurrency=max_connections,
+        cache=crawler.get("cache"),
+    )
+    asynchronous = crawler.get("mode", "async") == "async"
+    client, http_stats = make_client(
+        crawler.get("http"),
+        crawler.get("cache"),
+        max_connections if asynchronous else 1,
+        asynchronous=asynchronous,
+        base_url=crawler.get("base_url", BASE_URL),
+        params=params,
+    )
+    if asynchronous:
+        parse_workers = int(crawler.get("parse_workers", os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=parse_workers) as pool:
+            # Forked before the event loop and the loader thread start, see
+            # extract_property_details
+            pool.submit(int).result()
+            asyncio.run(
+                crawl_async(
+                    context,
+                    client,
+                    locations,
+                    today,
+                    max_connections_per_location=int(
+                        crawler.get("max_connections_per_location", 4)
+                    ),
+                    parser=parser,
+                    loader=loader,
+                    scheduler=scheduler,
+                    max_results=int(crawler.get("max_results", 1000)),
+                    metrics=run_metrics,
+                    pool=pool,
+                )
+            )
+    else:
+        crawl_sync(
+            context, client, locations, today, parser, loader, scheduler, run_metrics
+        )
 
-                for _property in properties:
-                    property_link = _property.find("a", class_="propertyCard-link")
-                    property_link = property_link["href"]
-
-                    property_id = property_link.split("/")[2] if property_link else ""
-                    # Extract small image URL
-                    small_image = _property.find("img", itemprop="image")["src"]
-
-                    # Extract title
-                    title = _property.find(
-                        "h2", class_="propertyCard-title"
-                    ).text.strip()
-
-                    # Extract description
-                    description = _property.find(
-                        "span", itemprop="description"
-                    ).text.strip()
-
-                    property_url = {
-                        "property_id": property_id,
-                        "property_url": property_link,
-                        "location_id": location["location_id"],
-                        "location_name": location["location_name"],
-                        "image": small_image,
-                        "description": description,
-                        "title": title,
-                        "date_added": today,
-                    }
-                    property_links.append(property_url)
-
-                index += 24
-                context.finish_current_step()
-
-    warehouse.load_data("property_links", property_links, schema="rightmove_raw")
+    loader.close()
+    run_metrics.count_all("scheduler", scheduler.report())
+    run_metrics.count_all("http", http_stats.report())
+    context.info(f"Run report: {run_metrics.write(metrics)}")
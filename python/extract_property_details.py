@@ -1,41 +1,136 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from typing import Any, Dict, List, Mapping, Optional
 
 import httpx
-from bs4 import BeautifulSoup
 from sayn import task
 from sayn.database import Database
 from sayn.tasks.task import Task
 
 import pandas as pd
 
-from .utils import format_field_name
+from .checkpoint import Checkpoint, ChunkedLoader, add_columns_query, table_ddl
+from .dedup import NearDuplicates, latest_of_clusters
+from .http_client import make_client
+from .metrics import Metrics
+from .normalize import normalize_listings
+from .parsers import get_parser
+from .scheduler import RequestScheduler
+from .seen_index import SeenIndex
+from .sharding import in_shard, shard_config, shard_table
 
 BASE_URL = "https://www.rightmove.co.uk/"
+CARD_FIELDS = (
+    "property_id",
+    "property_url",
+    "location_name",
+    "title",
+    "image",
+    "description",
+    "cluster_id",
+)
 
-template = {
-    "property_id": "",
-    "property_url": "",
-    "location_name": "",
-    "rent_pcm": "",
-    "let_available_date": "",
-    "deposit": "",
-    "min_tenancy": "",
-    "let_type": "",
-    "furnish_type": "",
-    "property_type": "",
-    "bedrooms": "",
-    "bathrooms": "",
-    "size": "",
-    "epc_rating_url": "",
-    "title": "",
-    "image": "",
-    "description": "",
-    "date_added": datetime.today(),
+# Crawled columns of models.f_properties and their types
+FACT_COLUMNS = {
+    "property_id": "STRING",
+    "property_url": "STRING",
+    "location_name": "STRING",
+    "rent_pcm": "INT64",
+    "let_available_date": "STRING",
+    "deposit": "INT64",
+    "min_tenancy": "STRING",
+    "let_type": "STRING",
+    "furnish_type": "STRING",
+    "property_type": "STRING",
+    "bedrooms": "INT64",
+    "bathrooms": "INT64",
+    "size": "FLOAT64",
+    "epc_rating_url": "STRING",
+    "title": "STRING",
+    "image": "STRING",
+    "description": "STRING",
+    "date_added": "TIMESTAMP",
+    "cluster_id": "STRING",
 }
+# Set from the app
+FLAG_COLUMNS = {"is_favourite": "INT64", "is_hidden": "INT64"}
 
 
-@task(sources="raw.property_links", outputs="intermediate.property_details")
-def extract_property_details(context: Task, warehouse: Database):
+def parse_property(_property: Mapping[str, Any], html: str, parser: str = "bs4"):
+    """Extract the raw fields of a listing page.
+
+    Runs in the parse workers, so it returns the time spent parsing instead of
+    recording it in the task metrics. Fields are typed and filtered a chunk at a
+    time by normalize_listings.
+    """
+    start = time.perf_counter()
+    listing = get_parser(parser).parse_listing(html)
+    listing.update({k: _property[k] for k in CARD_FIELDS})
+    return listing, {"parse": time.perf_counter() - start}
+
+
+def fetch_pages(
+    client: httpx.Client,
+    scheduler: RequestScheduler,
+    properties: List[Mapping[str, Any]],
+    pages: queue.Queue,
+    n_workers: int,
+    metrics: Metrics,
+):
+    """Start the fetch workers.
+
+    Each worker takes the next property and puts `(property, html or exception)`
+    in `pages`, blocking while the queue is full. A `None` is put once every
+    worker is done.
+    """
+    todo = iter(properties)
+    lock = threading.Lock()
+    remaining = [n_workers]
+
+    def worker():
+        while True:
+            with lock:
+                _property = next(todo, None)
+            if _property is None:
+                break
+            try:
+                response = scheduler.send(client, _property["property_url"])
+                metrics.observe("fetch", response.elapsed.total_seconds())
+                metrics.count("pages")
+                metrics.count("bytes", len(response.content))
+                response.raise_for_status()
+                pages.put((_property, response.text))
+            except Exception as e:
+                pages.put((_property, e))
+
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                pages.put(None)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(n_workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# With a single shard the details go straight to intermediate.property_details,
+# otherwise merge_property_details combines the shards into it
+@task(
+    sources="raw.property_links", outputs="intermediate.property_detail_shards"
+)
+def extract_property_details(
+    context: Task,
+    warehouse: Database,
+    crawler: Mapping[str, Any],
+    metrics: Mapping[str, Any],
+):
+    run_metrics = Metrics("extract_property_details")
     src_table = context.src("raw.property_links")
     properties = warehouse.read_data(
         f"""
@@ -49,7 +144,80 @@ def extract_property_details(context: Task, warehouse: Database):
     """
     )
 
-    # print(properties)
+    fetch_workers = int(crawler.get("fetch_workers", 8))
+    parse_workers = int(crawler.get("parse_workers", os.cpu_count() or 1))
+    queue_size = int(crawler.get("queue_size", 100))
+    parser = crawler.get("parser", "bs4")
+
+    # Before sharding, so every shard sees the whole clusters and keeps the same
+    # listing of each
+    near_duplicates = NearDuplicates.from_config(crawler.get("dedup"))
+    if near_duplicates is None:
+        for p in properties:
+            p["cluster_id"] = p["property_id"]
+    else:
+        with run_metrics.timer("dedup"):
+            cluster_ids = near_duplicates.clusters(properties)
+        for p, cluster_id in zip(properties, cluster_ids):
+            p["cluster_id"] = cluster_id
+        n_links = len(properties)
+        properties = [
+            properties[i] for i in latest_of_clusters(properties, cluster_ids)
+        ]
+        run_metrics.count("duplicates", n_links - len(properties))
+        context.info(
+            f"Skipping {n_links - len(properties)} near-duplicates of {n_links} properties"
+        )
+
+    shard_index, shard_count = shard_config(crawler)
+    properties = [
+        p for p in properties if in_shard(p["property_id"], shard_index, shard_count)
+    ]
+    table = shard_table("property_details", shard_index, shard_count)
+
+    seen_index = SeenIndex(
+        warehouse, crawler.get("seen_index", "seen_properties"), "rightmove_intermediate"
+    )
+    if is_incremental(context, crawler):
+        n_links = len(properties)
+        properties = seen_index.changed(properties)
+        context.info(
+            f"Incremental crawl: {len(properties)} new or changed of {n_links} properties"
+        )
+
+    today = datetime.now()
+    available_months = crawler.get("available_months", [6, 7])
+
+    def normalize(rows):
+        with run_metrics.timer("normalize"):
+            batch, messages = normalize_listings(rows, available_months, today)
+        run_metrics.count("records", len(batch))
+        run_metrics.count("filtered", len(rows) - len(batch))
+        for message in messages:
+            context.info(message)
+        return batch
+
+    checkpoint = Checkpoint(
+        crawler.get("checkpoint_dir", ".cache/checkpoints"),
+        table,
+        run_id=today.strftime("%Y-%m-%d"),
+    )
+    # The seen index is written as chunks are loaded, so a crash loses neither
+    loader = ChunkedLoader(
+        warehouse,
+        table,
+        "rightmove_intermediate",
+        checkpoint,
+        chunk_size=int(crawler.get("chunk_size", 500)),
+        replace=True,
+        on_flush=seen_index.commit,
+        metrics=run_metrics,
+        prepare=normalize,
+        columns=FACT_COLUMNS,
+    )
+    if checkpoint.resumed:
+        properties = [p for p in properties if not checkpoint.is_done(p["property_id"])]
+        context.info(f"Resuming the run, {len(properties)} properties left")
 
     p_buckets = int(len(properties) / 50)
     n_properties = len(properties)
@@ -57,98 +225,172 @@ def extract_property_details(context: Task, warehouse: Database):
         [f"Get Property {p * 50} / {n_properties}" for p in range(0, p_buckets + 1)]
     )
 
-    properties_details = []
-    with httpx.Client(base_url=BASE_URL) as client:
-        for idx, _property in enumerate(properties):
-            if (stp := idx % 50) == 0:
-                context.start_step(f"Get Property {idx} / {n_properties}")
-
-            property_url = _property["property_url"]
-            property_info = template.copy()
-            property_info["property_id"] = _property["property_id"]
-            property_info["property_url"] = BASE_URL[:-1] + property_url
-            property_info["location_name"] = _property["location_name"]
-            property_info["image"] = _property["image"]
-            property_info["title"] = _property["title"]
-            property_info["description"] = _property["description"]
+    processed = 0
 
-            try:
-                property_response = client.get(property_url)
-            except Exception as e:
-                context.info(e)
+    def collect(_property, result):
+        # Steps are counted on parsed pages, whatever order they finish in
+        nonlocal processed
+        if (stp := processed % 50) == 0:
+            context.start_step(f"Get Property {processed} / {n_properties}")
+
+        if result is not None:
+            listing, timings = result
+            for stage, seconds in timings.items():
+                run_metrics.observe(stage, seconds)
+            seen_index.mark(_property)
+            loader.add([listing], [_property["property_id"]])
+
+        processed += 1
+        if stp == 49 or processed == n_properties:
+            context.finish_current_step()
+
+    def collect_parsed(_property, future):
+        try:
+            result = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            # Skipped, and journaled so a resumed run doesn't fail on it again
+            context.info(f"Failed to parse {_property['property_url']}: {e!r}")
+            run_metrics.count("failed")
+            loader.add([], [_property["property_id"]])
+            result = None
+        collect(_property, result)
+
+    scheduler = RequestScheduler.from_config(
+        crawler.get("scheduler"),
+        max_concurrency=fetch_workers,
+        cache=crawler.get("cache"),
+    )
+    pages = queue.Queue(maxsize=queue_size)
+    client, http_stats = make_client(
+        crawler.get("http"),
+        crawler.get("cache"),
+        fetch_workers,
+        base_url=crawler.get("base_url", BASE_URL),
+    )
+    with client, ProcessPoolExecutor(max_workers=parse_workers) as pool:
+        # The workers are forked on the first task, before the fetch threads
+        # start: a child forked while they run can inherit a lock one of them
+        # holds and deadlock
+        pool.submit(int).result()
+        fetch_pages(client, scheduler, properties, pages, fetch_workers, run_metrics)
+
+        parsing = {}
+        while (item := pages.get()) is not None:
+            _property, page = item
+            if isinstance(page, Exception):
+                context.info(page)
+                run_metrics.count("failed")
+                collect(_property, None)
                 continue
 
-            property_soup = BeautifulSoup(property_response.text, "html.parser")
-
-            if rent := property_soup.select_one("div._1gfnqJ3Vtd1z40MlC0MzXu span"):
-                rent_pcm = (
-                    rent.text.replace("£", "")
-                    .replace("pcm", "")
-                    .replace(",", "")
-                    .strip()
-                )
-                property_info["rent_pcm"] = int(rent_pcm)
-
-            if property_detail := property_soup.select(
-                "dl._2E1qBJkWUYMJYHfYJzUb_r div"
-            ):
-                for dl in property_detail:
-                    property_info[format_field_name(dl.dt.string)] = str(
-                        dl.dd.string
-                        or dl.dd.span.next_sibling
-                        or dl.dd.span.previous_sibling
-                    )
-            if property_type := property_soup.select("div._4hBezflLdgDMdFtURKTWh dl"):
-                for dl in property_type:
-                    property_info[format_field_name(dl.dt.string)] = str(dl.dd.string)
-
-            epc_rating = property_soup.select_one(
-                "div._3BAkOrQAfGZMsQDtC0WdbO._3A8p_O-xNhCM7MwsZ_g0yj a"
-            )
-            property_info["epc_rating_url"] = epc_rating["href"] if epc_rating else ""
+            future = pool.submit(parse_property, _property, page, parser)
+            parsing[future] = _property
+            # Keep the number of pages held in the parse stage bounded too
+            if len(parsing) >= queue_size:
+                finished, _ = wait(parsing, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    collect_parsed(parsing.pop(future), future)
 
-            property_info["deposit"] = property_info["deposit"].replace(",", "")
-            property_info["bedrooms"] = (
-                property_info["bedrooms"][-1] if property_info["bedrooms"] else ""
-            )
-            property_info["bathrooms"] = (
-                property_info["bathrooms"][-1] if property_info["bathrooms"] else ""
-            )
+        for future in as_completed(parsing):
+            collect_parsed(parsing[future], future)
 
-            if property_info["size"]:
-                property_info["size"] = property_info["size"].split(" ")[0]
-                property_info["size"] = int(property_info["size"].replace(",", "").replace("-",""))
-                property_info["size"] = property_info["size"] * 0.092903
-            else:
-                property_info["size"] = ""
-            property_info = {k: property_info[k] for k in template.keys()}
-            if not property_soup.select(
-                "span.ksc_lozenge.berry._2WqVSGdiq2H4orAZsyHHgz"
-            ):
-                if property_info["let_available_date"] in ("Now", "Ask agent"):
-                    properties_details.append(property_info)
-                else:
-                    try:
-                        if int(property_info["let_available_date"].split("/")[1]) in (6, 7):
-                            properties_details.append(property_info)
-                    except:
-                        context.info(f'Found something weird {property_info["let_available_date"]}')
-
-            if stp == 49:
-                context.finish_current_step()
-
-    warehouse.load_data(
-        "property_details",
-        properties_details,
-        schema="rightmove_intermediate",
-        replace=True,
+    loader.close()
+    run_metrics.count_all("scheduler", scheduler.report())
+    run_metrics.count_all("http", http_stats.report())
+    context.info(f"Run report: {run_metrics.write(metrics)}")
+
+
+def is_incremental(context: Task, crawler: Mapping[str, Any]) -> bool:
+    """Incremental unless disabled in the crawler or on a full load (sayn run -f)"""
+    return crawler.get("incremental", False) and not context.run_arguments.get(
+        "full_load"
+    )
+
+
+def merge_facts_query(src_table: str, out_table: str) -> str:
+    """Upsert the latest details of each property into the facts.
+
+    Existing properties keep their is_favourite and is_hidden flags, which are
+    set from the app, new ones start with both at 0.
+    """
+    columns = ", ".join(FACT_COLUMNS) + ", is_favourite, is_hidden"
+    values = ", ".join(
+        f"SAFE_CAST(s.{name} AS {_type})" for name, _type in FACT_COLUMNS.items()
+    )
+    updates = ", ".join(
+        f"{name} = SAFE_CAST(s.{name} AS {_type})"
+        for name, _type in FACT_COLUMNS.items()
+        if name != "property_id"
+    )
+    return f"""
+    MERGE `{out_table}` AS t
+    USING (
+        SELECT *
+          FROM {src_table}
+         WHERE TRUE
+       QUALIFY ROW_NUMBER() OVER (PARTITION BY property_id ORDER BY date_added DESC) = 1
+    ) AS s
+       ON t.property_id = s.property_id
+     WHEN MATCHED THEN
+          UPDATE SET {updates}
+     WHEN NOT MATCHED THEN
+          INSERT ({columns})
+          VALUES ({values}, 0, 0)
+    """
+
+
+def cast_column(column: str, _type: str) -> str:
+    """Cast a column to a type, numbers may be written as text (eg: "£1725")"""
+    if _type not in ("INT64", "FLOAT64"):
+        return f"SAFE_CAST({column} AS {_type})"
+    number = (
+        f"SAFE_CAST(REGEXP_EXTRACT(REPLACE(CAST({column} AS STRING), ',', ''),"
+        r" r'\d+(?:\.\d+)?') AS FLOAT64)"
+    )
+    return f"SAFE_CAST(ROUND({number}) AS INT64)" if _type == "INT64" else number
+
+
+def migrate_facts_query(out_table: str, types: Mapping[str, str]) -> Optional[str]:
+    """Rebuild the facts with their columns cast to the types of FACT_COLUMNS.
+
+    `types` are the column types of the table as it is. Tables created before
+    the numbers were typed hold them as text, CREATE TABLE IF NOT EXISTS leaves
+    them so and the merge would fail on them. None when nothing differs.
+    """
+    casts = [
+        f"{cast_column(name, _type)} AS {name}"
+        for name, _type in FACT_COLUMNS.items()
+        if name in types and types[name] != _type
+    ]
+    if not casts:
+        return None
+    return f"""
+    CREATE OR REPLACE TABLE `{out_table}` AS
+    SELECT * REPLACE ({", ".join(casts)})
+      FROM `{out_table}`
+    """
+
+
+def column_types(warehouse: Database, table: str) -> Dict[str, str]:
+    dataset, name = table.split(".")
+    rows = warehouse.read_data(
+        f"""
+    SELECT column_name, data_type
+      FROM `{dataset}`.INFORMATION_SCHEMA.COLUMNS
+     WHERE table_name = '{name}'
+    """
     )
+    return {row["column_name"]: row["data_type"] for row in rows}
 
 
 @task(sources="intermediate.property_details", outputs="models.f_properties")
 def extract_property_facts(
     context: Task,
     warehouse: Database,
+    crawler: Mapping[str, Any],
+    facts_load: str,
 ):
     with context.step("Check if table exists:"):
         out_table = context.out("models.f_properties")
@@ -160,43 +402,62 @@ def extract_property_facts(
                 location_name	    STRING,				
                 rent_pcm	        INTEGER,	
                 let_available_date	STRING,			
-                deposit	            STRING,
+                deposit	            INTEGER,
                 min_tenancy	        STRING,			
                 let_type	        STRING,			
                 furnish_type	    STRING,				
                 property_type	    STRING,				
-                bedrooms	        STRING,
-                bathrooms	        STRING,			
-                size	            STRING,
+                bedrooms	        INTEGER,
+                bathrooms	        INTEGER,			
+                size	            FLOAT64,
                 epc_rating_url	    STRING,				
                 title	            STRING,
                 image	            STRING,		
                 description	        STRING,	
                 date_added	        TIMESTAMP,
+                cluster_id	        STRING,
                 is_favourite        INTEGER,
                 is_hidden           INTEGER	
             );
             """
         )
 
+    with context.step("Migrate columns"):
+        # eg: cluster_id, which the app reads
+        warehouse.execute(
+            add_columns_query(f"`{out_table}`", {**FACT_COLUMNS, **FLAG_COLUMNS})
+        )
+        if query := migrate_facts_query(out_table, column_types(warehouse, out_table)):
+            context.info("Casting the columns of the facts to their current types")
+            warehouse.execute(query)
+
+    src_table = context.src("intermediate.property_details")
+    if facts_load == "merge":
+        with context.step("Merge new Properties"):
+            warehouse.execute(merge_facts_query(src_table, out_table))
+        return context.success()
+
     with context.step("Merge new Properties"):
-        src_table = context.src("intermediate.property_details")
         values = warehouse.read_data(f"SELECT * FROM {src_table}")
         df_new = pd.DataFrame(values).drop_duplicates(subset="property_id")
 
-        df_old = pd.DataFrame(warehouse.read_data(f"SELECT * FROM {out_table}"))[
-            ["property_id", "is_favourite", "is_hidden"]
-        ]
+        df_all = pd.DataFrame(warehouse.read_data(f"SELECT * FROM {out_table}"))
+        df_old = df_all[["property_id", "is_favourite", "is_hidden"]]
         df_new = df_new.merge(df_old, on="property_id", how="left")
         df_new[["is_favourite", "is_hidden"]] = df_new[
             ["is_favourite", "is_hidden"]
         ].fillna(0)
 
+        if is_incremental(context, crawler):
+            # The details only hold new or changed properties, keep the rest
+            df_kept = df_all[~df_all["property_id"].isin(df_new["property_id"])]
+            df_new = pd.concat([df_kept, df_new], ignore_index=True)
+
         df_new["date_added"] = (
             df_new["date_added"].apply((lambda x: x.to_pydatetime())).astype(str)
         )
 
-        output = df_new.to_dict("records")
+        output = df_new[[*FACT_COLUMNS, *FLAG_COLUMNS]].to_dict("records")
 
         for o in output:
             o["date_added"] = datetime.strptime(
@@ -211,6 +472,7 @@ def extract_property_facts(
             output,
             schema=s_name,
             replace=True,
+            **table_ddl(warehouse, {**FACT_COLUMNS, **FLAG_COLUMNS}),
         )
 
     return context.success()
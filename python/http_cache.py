@@ -0,0 +1,305 @@
+"""On-disk cache for the crawlers' httpx clients.
+
+Response bodies are stored once per content hash under `<path>/blobs` and an
+sqlite index maps each GET url to its status, headers and body. Entries are
+served as they are while younger than `ttl` seconds, then revalidated with
+If-None-Match / If-Modified-Since when the server sent an ETag or
+Last-Modified. Least recently used entries are evicted once the blobs go over
+`max_size_mb`.
+
+Modes:
+- off: no cache
+- on: serve fresh entries, revalidate or fetch the rest
+- replay: never touch the network, a missing entry is a 504
+
+Responses the cache answers itself (hits and replay misses) carry the
+`from_cache` extension. A request with the `cache_only` extension is answered
+from the cache or with a 504 without it, never from the network: the request
+scheduler asks that way first, so what's on disk isn't rate limited.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Mapping, Optional, Union
+
+import httpx
+
+MODES = ("off", "on", "replay")
+# Request extension: don't go to the network
+CACHE_ONLY = "cache_only"
+# Response extension: answered by the cache
+FROM_CACHE = "from_cache"
+
+# Headers describing a response are kept, hop-by-hop ones are not
+DROP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "set-cookie"}
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttl: float, max_size: int):
+        self.path = Path(path)
+        self.blobs = self.path / "blobs"
+        self.blobs.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path / "index.sqlite", check_same_thread=False, isolation_level=None
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key           TEXT PRIMARY KEY,
+                url           TEXT,
+                status        INTEGER,
+                headers       TEXT,
+                digest        TEXT,
+                etag          TEXT,
+                last_modified TEXT,
+                stored_at     REAL,
+                accessed_at   REAL
+            )"""
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER)"
+        )
+
+    @staticmethod
+    def key(request: httpx.Request) -> str:
+        return hashlib.sha256(f"{request.method} {request.url}".encode()).hexdigest()
+
+    def _blob(self, digest: str) -> Path:
+        return self.blobs / digest[:2] / digest
+
+    def get(self, key: str) -> Optional[Mapping[str, Any]]:
+        with self._lock:
+            row = self._db.execute(
+                """SELECT status, headers, digest, etag, last_modified, stored_at
+                     FROM responses
+                    WHERE key = ?""",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+
+        status, headers, digest, etag, last_modified, stored_at = row
+        try:
+            content = self._blob(digest).read_bytes()
+        except FileNotFoundError:
+            return None
+
+        return {
+            "status": status,
+            "headers": json.loads(headers),
+            "content": content,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fresh": time.time() - stored_at < self.ttl,
+        }
+
+    def put(self, request: httpx.Request, response: httpx.Response, content: bytes):
+        digest = hashlib.sha256(content).hexdigest()
+        blob = self._blob(digest)
+        if not blob.exists():
+            blob.parent.mkdir(exist_ok=True)
+            tmp = blob.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp.write_bytes(content)
+            tmp.replace(blob)
+
+        headers = [
+            (k, v) for k, v in response.headers.multi_items() if k not in DROP_HEADERS
+        ]
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO blobs VALUES (?, ?)", (digest, len(content))
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.key(request),
+                    str(request.url),
+                    response.status_code,
+                    json.dumps(headers),
+                    digest,
+                    response.headers.get("etag"),
+                    response.headers.get("last-modified"),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+
+    def touch(self, key: str):
+        """Mark a revalidated entry as fresh again"""
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?",
+                (now, now, key),
+            )
+
+    def _evict(self):
+        (size,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        if size <= self.max_size:
+            return
+
+        lru = self._db.execute(
+            "SELECT key FROM responses ORDER BY accessed_at"
+        ).fetchall()
+        for (key,) in lru:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            orphans = self._db.execute(
+                """SELECT digest, size
+                     FROM blobs
+                    WHERE digest NOT IN (SELECT digest FROM responses)"""
+            ).fetchall()
+            for digest, blob_size in orphans:
+                self._blob(digest).unlink(missing_ok=True)
+                self._db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                size -= blob_size
+            if size <= self.max_size:
+                break
+
+
+class _CachingMixin:
+    def __init__(self, transport, cache: ResponseCache, mode: str):
+        self.transport = transport
+        self.cache = cache
+        self.mode = mode
+
+    def _lookup(self, request: httpx.Request):
+        """Return (key, entry, response to serve without the network or None)"""
+        if request.method != "GET":
+            return None, None, None
+
+        key = self.cache.key(request)
+        entry = self.cache.get(key)
+        if entry is not None and (entry["fresh"] or self.mode == "replay"):
+            self.cache.hits += 1
+            return key, entry, self._cached(request, entry)
+        if self.mode == "replay":
+            self.cache.misses += 1
+            return key, entry, httpx.Response(
+                504,
+                request=request,
+                text=f"Not in the replay cache: {request.url}",
+                extensions={FROM_CACHE: True},
+            )
+        if request.extensions.get(CACHE_ONLY):
+            return key, entry, httpx.Response(504, request=request)
+
+        if entry is not None:
+            if entry["etag"]:
+                request.headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                request.headers["If-Modified-Since"] = entry["last_modified"]
+        return key, entry, None
+
+    def _cached(
+        self, request: httpx.Request, entry: Mapping[str, Any], extensions=None
+    ):
+        return httpx.Response(
+            entry["status"],
+            headers=entry["headers"],
+            content=entry["content"],
+            request=request,
+            extensions={FROM_CACHE: True} if extensions is None else extensions,
+        )
+
+    def _revalidated(
+        self, key: str, entry, request: httpx.Request, response: httpx.Response
+    ):
+        self.cache.revalidated += 1
+        self.cache.touch(key)
+        # The host was asked, the response is the network's
+        return self._cached(request, entry, response.extensions)
+
+    def _store(self, request: httpx.Request, response: httpx.Response, content: bytes):
+        self.cache.misses += 1
+        # The raw (still encoded) body is kept, so the headers stay accurate
+        if response.status_code == 200:
+            self.cache.put(request, response, content)
+        return httpx.Response(
+            response.status_code,
+            headers=response.headers,
+            content=content,
+            request=request,
+            extensions=response.extensions,
+        )
+
+
+class CachingTransport(_CachingMixin, httpx.BaseTransport):
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        key, entry, cached = self._lookup(request)
+        if cached is not None:
+            return cached
+        if key is None:
+            return self.transport.handle_request(request)
+
+        response = self.transport.handle_request(request)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            return self._revalidated(key, entry, request, response)
+
+        try:
+            content = b"".join(response.iter_raw())
+        finally:
+            response.close()
+        return self._store(request, response, content)
+
+    def close(self):
+        self.transport.close()
+
+
+class AsyncCachingTransport(_CachingMixin, httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key, entry, cached = self._lookup(request)
+        if cached is not None:
+            return cached
+        if key is None:
+            return await self.transport.handle_async_request(request)
+
+        response = await self.transport.handle_async_request(request)
+        if response.status_code == 304 and entry is not None:
+            await response.aclose()
+            return self._revalidated(key, entry, request, response)
+
+        try:
+            content = b"".join([chunk async for chunk in response.aiter_raw()])
+        finally:
+            await response.aclose()
+        return self._store(request, response, content)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def wrap_transport(
+    config: Optional[Mapping[str, Any]],
+    transport: Union[httpx.BaseTransport, httpx.AsyncBaseTransport],
+):
+    """Put the cache of the crawler `cache` parameter in front of a transport"""
+    config = config or {}
+    if (mode := config.get("mode", "off")) not in MODES:
+        raise ValueError(f"Unknown cache mode {mode}. Valid modes: {', '.join(MODES)}")
+    if mode == "off":
+        return transport
+
+    cache = ResponseCache(
+        config.get("path", ".cache/http"),
+        ttl=float(config.get("ttl", 24 * 3600)),
+        max_size=int(config.get("max_size_mb", 2048)) * 1024 * 1024,
+    )
+    if isinstance(transport, httpx.AsyncBaseTransport):
+        return AsyncCachingTransport(transport, cache, mode)
+    return CachingTransport(transport, cache, mode)
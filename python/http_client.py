@@ -0,0 +1,155 @@
+"""httpx clients shared by every crawler.
+
+All the crawlers get their client from `make_client`, tuned from the crawler
+`http` parameter:
+
+- HTTP/2 (`http2`), so concurrent requests to the site are multiplexed over a
+  few connections instead of one connection each
+- brotli and gzip responses, httpx asks for br when the brotli package is
+  installed and decodes the bodies
+- keep-alive pool sized by the caller (max_connections, fetch_workers), with
+  idle connections kept for `keepalive_expiry` seconds
+- the same default headers on every request
+
+Connection reuse is counted through the `trace` request extension: `report`
+returns the requests sent over the network, the connections opened for them
+(the fewer connections per request, the more reuse) and the HTTP versions used.
+"""
+import threading
+import urllib.request
+from collections import Counter
+from typing import Any, Dict, Mapping, Optional
+
+import httpx
+
+from .http_cache import FROM_CACHE, wrap_transport
+
+DEFAULT_HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/120.0 Safari/537.36"
+    ),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-GB,en;q=0.9",
+}
+
+
+def site_proxy(base_url: str) -> Optional[str]:
+    """Proxy for the crawled site from the environment (HTTPS_PROXY, NO_PROXY...)
+
+    httpx only reads them for the transports it builds itself.
+    """
+    url = httpx.URL(base_url)
+    if not url.host or urllib.request.proxy_bypass(url.host):
+        return None
+    return urllib.request.getproxies().get(url.scheme)
+
+
+class ConnectionStats:
+    """Requests, connections and HTTP versions seen by a client"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.cached = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.versions: Counter = Counter()
+
+    def trace(self, event: str, info: Mapping[str, Any]):
+        if event == "connection.connect_tcp.complete":
+            with self.lock:
+                self.connections += 1
+        elif event == "connection.start_tls.complete":
+            with self.lock:
+                self.tls_handshakes += 1
+
+    async def atrace(self, event: str, info: Mapping[str, Any]):
+        self.trace(event, info)
+
+    def on_request(self, request: httpx.Request):
+        request.extensions["trace"] = self.trace
+
+    async def aon_request(self, request: httpx.Request):
+        request.extensions["trace"] = self.atrace
+
+    def on_response(self, response: httpx.Response):
+        with self.lock:
+            if response.extensions.get(FROM_CACHE):
+                self.cached += 1
+                return
+            if "network_stream" not in response.extensions:
+                # Asked the cache only and it didn't have the page
+                return
+            self.requests += 1
+            self.versions[response.http_version] += 1
+
+    async def aon_response(self, response: httpx.Response):
+        self.on_response(response)
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            report = {
+                "requests": self.requests,
+                "cached": self.cached,
+                "connections": self.connections,
+                "tls_handshakes": self.tls_handshakes,
+                "versions": dict(self.versions),
+            }
+        return report
+
+
+def make_client(
+    config: Optional[Mapping[str, Any]],
+    cache: Optional[Mapping[str, Any]],
+    max_connections: int,
+    asynchronous: bool = False,
+    **kwargs,
+):
+    """Build a client from the crawler `http` and `cache` parameters.
+
+    Returns (client, stats). Other keyword arguments (base_url, params...) go to
+    the client.
+    """
+    config = config or {}
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=max_connections,
+        keepalive_expiry=float(config.get("keepalive_expiry", 30)),
+    )
+    stats = ConnectionStats()
+    transport_options = dict(
+        limits=limits,
+        http2=bool(config.get("http2", True)),
+        proxy=site_proxy(kwargs.get("base_url", "")),
+    )
+    transport = wrap_transport(
+        cache,
+        httpx.AsyncHTTPTransport(**transport_options)
+        if asynchronous
+        else httpx.HTTPTransport(**transport_options),
+    )
+
+    options = dict(
+        transport=transport,
+        headers=DEFAULT_HEADERS,
+        timeout=httpx.Timeout(float(config.get("timeout", 5))),
+        **kwargs,
+    )
+    if asynchronous:
+        client = httpx.AsyncClient(
+            event_hooks={
+                "request": [stats.aon_request],
+                "response": [stats.aon_response],
+            },
+            **options,
+        )
+    else:
+        client = httpx.Client(
+            event_hooks={
+                "request": [stats.on_request],
+                "response": [stats.on_response],
+            },
+            **options,
+        )
+    return client, stats
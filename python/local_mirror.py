@@ -0,0 +1,140 @@
+import sqlite3
+from pathlib import Path
+from typing import Any, Mapping
+
+from sayn import task
+from sayn.database import Database
+from sayn.tasks.task import Task
+
+from .extract_property_details import FACT_COLUMNS, FLAG_COLUMNS
+
+SQLITE_TYPES = {
+    "STRING": "TEXT",
+    "INT64": "INTEGER",
+    "FLOAT64": "REAL",
+    "TIMESTAMP": "TEXT",
+}
+
+COLUMNS = {
+    **{name: SQLITE_TYPES[_type] for name, _type in FACT_COLUMNS.items()},
+    **{name: SQLITE_TYPES[_type] for name, _type in FLAG_COLUMNS.items()},
+}
+
+
+def to_sqlite(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def download(uri: str, path: Path) -> bool:
+    """Copy the mirror uploaded to `uri` (gs://bucket/name) to `path`"""
+    from google.cloud import storage
+
+    blob = storage.Blob.from_string(uri, client=storage.Client())
+    if not blob.exists():
+        return False
+    blob.download_to_filename(str(path))
+    return True
+
+
+def upload(path: Path, uri: str):
+    from google.cloud import storage
+
+    storage.Blob.from_string(uri, client=storage.Client()).upload_from_filename(
+        str(path)
+    )
+
+
+@task(sources="models.f_properties")
+def sync_local_mirror(
+    context: Task, warehouse: Database, local_mirror: Mapping[str, Any]
+):
+    """Copy models.f_properties to the sqlite file the app reads from.
+
+    Properties crawled since the last sync are copied in full, the favourite and
+    hidden flags of every property are refreshed and properties no longer in
+    the table are deleted. A full load (sayn run -f) copies the whole table
+    again.
+
+    With a `gcs_uri` the mirror is uploaded there for the app, which downloads
+    it when it starts, and the next sync starts from that copy.
+    """
+    src_table = context.src("models.f_properties")
+    path = Path(local_mirror.get("path", "data/f_properties.sqlite"))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    gcs_uri = local_mirror.get("gcs_uri")
+
+    with context.step("Prepare mirror"):
+        if gcs_uri and not path.exists() and download(gcs_uri, path):
+            context.info(f"Mirror downloaded from {gcs_uri}")
+        db = sqlite3.connect(path)
+        columns = ", ".join(f"{name} {_type}" for name, _type in COLUMNS.items())
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS f_properties ({columns}, "
+            "PRIMARY KEY (property_id))"
+        )
+        # Columns added to f_properties since the mirror was created
+        existing = {row[1] for row in db.execute("PRAGMA table_info(f_properties)")}
+        for name, _type in COLUMNS.items():
+            if name not in existing:
+                db.execute(f"ALTER TABLE f_properties ADD COLUMN {name} {_type}")
+        db.execute(
+            "CREATE INDEX IF NOT EXISTS f_properties_location "
+            "ON f_properties (location_name)"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS sync_state (watermark TEXT)")
+        (watermark,) = db.execute("SELECT MAX(watermark) FROM sync_state").fetchone()
+        if context.run_arguments.get("full_load"):
+            watermark = None
+
+    with context.step("Copy properties"):
+        if watermark is None:
+            rows = warehouse.read_data(f"SELECT * FROM {src_table}")
+        else:
+            rows = warehouse.read_data(
+                f"SELECT * FROM {src_table} WHERE date_added > TIMESTAMP('{watermark}')"
+            )
+
+        names = list(COLUMNS.keys())
+        with db:
+            if watermark is None:
+                db.execute("DELETE FROM f_properties")
+            db.executemany(
+                f"INSERT OR REPLACE INTO f_properties ({', '.join(names)}) "
+                f"VALUES ({', '.join('?' for _ in names)})",
+                [[to_sqlite(row.get(name)) for name in names] for row in rows],
+            )
+        context.info(f"{len(rows)} properties copied")
+
+    with context.step("Refresh flags"):
+        flags = warehouse.read_data(
+            f"SELECT property_id, is_favourite, is_hidden FROM {src_table}"
+        )
+        with db:
+            db.executemany(
+                "UPDATE f_properties SET is_favourite = ?, is_hidden = ? "
+                "WHERE property_id = ?",
+                [(f["is_favourite"], f["is_hidden"], f["property_id"]) for f in flags],
+            )
+            # The watermark only finds new rows, deleted ones go here
+            db.execute("CREATE TEMP TABLE current_ids (property_id TEXT PRIMARY KEY)")
+            db.executemany(
+                "INSERT OR IGNORE INTO current_ids VALUES (?)",
+                [(f["property_id"],) for f in flags],
+            )
+            deleted = db.execute(
+                "DELETE FROM f_properties "
+                "WHERE property_id NOT IN (SELECT property_id FROM current_ids)"
+            ).rowcount
+            context.info(f"{deleted} properties deleted")
+            if rows:
+                latest = max(to_sqlite(row["date_added"]) for row in rows)
+                db.execute("DELETE FROM sync_state")
+                db.execute("INSERT INTO sync_state VALUES (?)", (latest,))
+
+    db.close()
+
+    if gcs_uri:
+        with context.step("Upload mirror"):
+            upload(path, gcs_uri)
+
+    return context.success()
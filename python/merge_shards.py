@@ -0,0 +1,101 @@
+from typing import Any, Mapping
+
+from sayn import task
+from sayn.database import Database
+from sayn.tasks.task import Task
+
+from .checkpoint import add_columns_query
+from .extract_properties import LINK_COLUMNS
+from .seen_index import compact_query
+from .sharding import shard_config, shard_table
+
+
+def union_shards(schema: str, table: str, shard_count: int) -> str:
+    """Latest row of each property across the shard staging tables"""
+    shards = "\n UNION ALL\n".join(
+        f"SELECT * FROM {schema}.{shard_table(table, i, shard_count)}"
+        for i in range(shard_count)
+    )
+    return f"""
+    SELECT *
+      FROM ({shards})
+     WHERE TRUE
+   QUALIFY ROW_NUMBER() OVER (PARTITION BY property_id ORDER BY date_added DESC) = 1
+    """
+
+
+def drop_shards(warehouse: Database, schema: str, table: str, shard_count: int):
+    for i in range(shard_count):
+        warehouse.execute(
+            f"DROP TABLE IF EXISTS {schema}.{shard_table(table, i, shard_count)}"
+        )
+
+
+@task(sources="raw.property_link_shards", outputs="raw.property_links")
+def merge_property_links(
+    context: Task, warehouse: Database, crawler: Mapping[str, Any]
+):
+    """Append the links of every shard to raw.property_links.
+
+    Fails if a shard's table is missing, so a shard that didn't finish is
+    never merged silently.
+    """
+    _, shard_count = shard_config(crawler)
+    if shard_count == 1:
+        context.info("Not sharded, nothing to merge")
+        return context.success()
+
+    out_table = context.out("raw.property_links")
+    schema, table = out_table.split(".")
+    with context.step("Merge shards"):
+        warehouse.execute(
+            f"""CREATE TABLE IF NOT EXISTS {out_table} AS
+            SELECT * FROM {schema}.{shard_table(table, 0, shard_count)} WHERE FALSE
+            """
+        )
+        warehouse.execute(add_columns_query(out_table, LINK_COLUMNS))
+        # Columns added since the table was created come last, name them
+        columns = ", ".join(LINK_COLUMNS)
+        warehouse.execute(
+            f"INSERT INTO {out_table} ({columns}) SELECT {columns} FROM "
+            f"({union_shards(schema, table, shard_count)})"
+        )
+
+    with context.step("Drop shards"):
+        drop_shards(warehouse, schema, table, shard_count)
+
+    return context.success()
+
+
+@task(
+    sources="intermediate.property_detail_shards",
+    outputs="intermediate.property_details",
+)
+def merge_property_details(
+    context: Task, warehouse: Database, crawler: Mapping[str, Any]
+):
+    """Replace intermediate.property_details with the details of every shard.
+
+    Also compacts the seen index the crawl appended to, sharded or not.
+    """
+    out_table = context.out("intermediate.property_details")
+    schema, table = out_table.split(".")
+    with context.step("Compact seen index"):
+        seen_table = crawler.get("seen_index", "seen_properties")
+        warehouse.execute(compact_query(f"{schema}.{seen_table}"))
+
+    _, shard_count = shard_config(crawler)
+    if shard_count == 1:
+        context.info("Not sharded, nothing to merge")
+        return context.success()
+
+    with context.step("Merge shards"):
+        warehouse.execute(
+            f"CREATE OR REPLACE TABLE {out_table} AS "
+            f"{union_shards(schema, table, shard_count)}"
+        )
+
+    with context.step("Drop shards"):
+        drop_shards(warehouse, schema, table, shard_count)
+
+    return context.success()
@@ -0,0 +1,147 @@
+"""Timers and counters for the crawl and export tasks.
+
+Stage timings (fetch, parse, normalize, load...) go in histograms with fixed
+buckets, so they stay cheap to record from many threads. At the end of a task
+`write` saves a json run report and, optionally, the same figures in the
+Prometheus text format for a node exporter textfile collector.
+"""
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Mapping, Optional
+
+# Seconds, from 1ms to ~33s
+BUCKETS = tuple(0.001 * 2**i for i in range(16))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the q-th quantile"""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 3),
+            "mean": round(self.sum / self.count, 4) if self.count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 4),
+        }
+
+
+class Metrics:
+    def __init__(self, task_name: str):
+        self.task_name = task_name
+        self.started = datetime.now()
+        self._start = time.perf_counter()
+        self.stages: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            if stage not in self.stages:
+                self.stages[stage] = Histogram()
+            self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, counter: str, value: float = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def count_all(self, prefix: str, report: Mapping[str, Any]):
+        """Count the figures of another component's report, eg: the scheduler's"""
+        for counter, value in report.items():
+            if isinstance(value, (int, float)):
+                self.count(f"{prefix}_{counter}", value)
+
+    def report(self) -> Dict[str, Any]:
+        duration = time.perf_counter() - self._start
+        with self._lock:
+            return {
+                "task": self.task_name,
+                "started": self.started.isoformat(),
+                "duration": round(duration, 3),
+                "counters": dict(self.counters),
+                "per_second": {
+                    k: round(v / duration, 3) for k, v in self.counters.items()
+                },
+                "stages": {k: v.summary() for k, v in self.stages.items()},
+            }
+
+    def to_prometheus(self) -> str:
+        prefix = "rightmove_crawl"
+        task = f'task="{self.task_name}"'
+        lines = [
+            f"# TYPE {prefix}_duration_seconds gauge",
+            f"{prefix}_duration_seconds{{{task}}} {time.perf_counter() - self._start}",
+        ]
+        with self._lock:
+            for counter, value in self.counters.items():
+                lines.append(f'{prefix}_total{{{task},counter="{counter}"}} {value}')
+
+            lines.append(f"# TYPE {prefix}_stage_seconds histogram")
+            for stage, hist in self.stages.items():
+                labels = f'{task},stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(hist.buckets, hist.counts):
+                    cumulative += count
+                    lines.append(
+                        f'{prefix}_stage_seconds_bucket{{{labels},le="{bound}"}} '
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f'{prefix}_stage_seconds_bucket{{{labels},le="+Inf"}} {hist.count}'
+                )
+                lines.append(f"{prefix}_stage_seconds_sum{{{labels}}} {hist.sum}")
+                lines.append(f"{prefix}_stage_seconds_count{{{labels}}} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, config: Optional[Mapping[str, Any]]) -> Dict[str, Any]:
+        """Save the run report as set in the `metrics` parameter and return it"""
+        config = config or {}
+        report = self.report()
+        directory = Path(config.get("directory", ".cache/metrics"))
+        directory.mkdir(parents=True, exist_ok=True)
+
+        stamp = self.started.strftime("%Y%m%dT%H%M%S")
+        (directory / f"{self.task_name}-{stamp}.json").write_text(
+            json.dumps(report, indent=2)
+        )
+        if config.get("prometheus", False):
+            (directory / f"{self.task_name}.prom").write_text(self.to_prometheus())
+        return report
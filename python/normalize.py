@@ -0,0 +1,102 @@
+"""Batch normalisation of the listing fields.
+
+The parse workers return the fields as they appear on the page (eg: "£1,500
+pcm", "×2", "678 sq ft"). They are turned into typed columns and filtered a
+chunk at a time, with pandas string and numeric ops over whole columns.
+
+Listings are kept when they aren't let agreed and are available now, on
+asking the agent or in one of the `available_months` crawler parameter (every
+date when it's empty).
+"""
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .records import FIELDS, RecordBatch
+
+# Listing urls are stored in full, the cards only have their path
+SITE_URL = "https://www.rightmove.co.uk"
+NUMBER = r"(\d[\d,]*(?:\.\d+)?)"
+# dd/mm/yyyy, the format of dated availabilities
+DATE_MONTH = r"^\s*\d{1,2}/(\d{1,2})/\d{2,4}\s*$"
+ALWAYS_AVAILABLE = ("Now", "Ask agent")
+SQFT_TO_SQM = 0.092903
+
+INT_FIELDS = ("rent_pcm", "deposit", "bedrooms", "bathrooms")
+NUMERIC_FIELDS = INT_FIELDS + ("size",)
+
+
+def to_numbers(column: pd.Series) -> pd.Series:
+    """First number in each text, NaN when there's none"""
+    numbers = column.str.extract(NUMBER, expand=False)
+    return pd.to_numeric(numbers.str.replace(",", "", regex=False), errors="coerce")
+
+
+def to_column(values: np.ndarray, integer: bool = False) -> List[Any]:
+    """Python values with None for the NaNs"""
+    missing = np.isnan(values)
+    if integer:
+        values = np.rint(np.where(missing, 0, values)).astype(np.int64)
+    column = values.astype(object)
+    column[missing] = None
+    return column.tolist()
+
+
+def availability(
+    dates: pd.Series, available_months: Optional[Iterable[int]]
+) -> Tuple[pd.Series, pd.Series]:
+    """Return (available, unreadable) masks of the let available dates"""
+    dates = dates.fillna("").astype(str)
+    always = dates.isin(ALWAYS_AVAILABLE)
+    months = pd.to_numeric(dates.str.extract(DATE_MONTH, expand=False))
+    unreadable = ~always & months.isna()
+    if not available_months:
+        return ~unreadable, unreadable
+    return always | months.isin(list(available_months)), unreadable
+
+
+def normalize_listings(
+    rows: List[Mapping[str, Any]],
+    available_months: Optional[Iterable[int]] = (6, 7),
+    date_added: Optional[datetime] = None,
+) -> Tuple[RecordBatch, List[str]]:
+    """Type and filter a chunk of parsed listings.
+
+    Rows hold the search card fields and the raw listing fields. Returns the
+    batch of records kept and a message for each unreadable date.
+    """
+    if not rows:
+        return RecordBatch(), []
+
+    df = pd.DataFrame.from_records(rows)
+    let_agreed = df["let_agreed"].astype(bool)
+    available, unreadable = availability(df["let_available_date"], available_months)
+    messages = [
+        f"Found something weird {date}"
+        for date in df.loc[unreadable & ~let_agreed, "let_available_date"]
+    ]
+    df = df[available & ~let_agreed]
+
+    # The numeric fields go through the regex as a single column
+    stacked = pd.Series(
+        np.concatenate([df[field].to_numpy(object) for field in NUMERIC_FIELDS]),
+        dtype=object,
+    ).fillna("")
+    numbers = to_numbers(stacked).to_numpy(float).reshape(len(NUMERIC_FIELDS), -1)
+
+    columns: Dict[str, Any] = {}
+    for field in FIELDS:
+        if field in INT_FIELDS:
+            columns[field] = to_column(numbers[INT_FIELDS.index(field)], integer=True)
+        elif field == "size":
+            columns[field] = to_column(numbers[-1] * SQFT_TO_SQM)
+        elif field == "property_url":
+            columns[field] = (SITE_URL + df[field]).tolist()
+        elif field == "date_added":
+            columns[field] = [date_added or datetime.today()] * len(df)
+        else:
+            columns[field] = df[field].fillna("").astype(str).tolist()
+
+    return RecordBatch.from_columns(columns), messages
@@ -0,0 +1,356 @@
+"""Page parsers for the Rightmove crawlers.
+
+Every backend turns a page into the same raw fields, so the crawl tasks can
+switch backend through the `parser` crawler parameter:
+
+- bs4: BeautifulSoup with the css selectors the site renders
+- selectolax: the same selectors on a much faster C parser
+- json: reads the page model the site embeds in a script tag, falling back to
+  bs4 when a page has none
+
+Listing fields are left as they appear on the page (eg: "£1,500 pcm", "678 sq
+ft"); cleaning them up is the caller's job.
+"""
+import json
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from .utils import format_field_name
+
+LISTING_FIELDS = (
+    "rent_pcm",
+    "let_available_date",
+    "deposit",
+    "min_tenancy",
+    "let_type",
+    "furnish_type",
+    "property_type",
+    "bedrooms",
+    "bathrooms",
+    "size",
+    "epc_rating_url",
+)
+
+RENT_SELECTOR = "div._1gfnqJ3Vtd1z40MlC0MzXu span"
+LETTING_DETAILS_SELECTOR = "dl._2E1qBJkWUYMJYHfYJzUb_r div"
+PROPERTY_DETAILS_SELECTOR = "div._4hBezflLdgDMdFtURKTWh dl"
+EPC_SELECTOR = "div._3BAkOrQAfGZMsQDtC0WdbO._3A8p_O-xNhCM7MwsZ_g0yj a"
+LET_AGREED_SELECTOR = "span.ksc_lozenge.berry._2WqVSGdiq2H4orAZsyHHgz"
+CARD_ID = re.compile(r"property-[1-9]\d+")
+RESULT_COUNT_SELECTOR = "span.searchHeader-resultCount"
+CARD_RENT_SELECTOR = "span.propertyCard-priceValue"
+
+# The cards of a search results page and its result count
+SearchPage = Tuple[List[Dict[str, Any]], Optional[int]]
+
+
+def empty_listing() -> Dict[str, Any]:
+    listing = {k: "" for k in LISTING_FIELDS}
+    listing["let_agreed"] = False
+    return listing
+
+
+def property_id_from_url(property_url: str) -> str:
+    return property_url.split("/")[2] if property_url else ""
+
+
+def to_count(text: Optional[str]) -> Optional[int]:
+    try:
+        return int(str(text).replace(",", "").strip())
+    except ValueError:
+        return None
+
+
+class Bs4Parser:
+    name = "bs4"
+    # Extraction steps of parse_listing, each fills in fields of the listing
+    listing_stages = (
+        "rent",
+        "letting_details",
+        "property_details",
+        "epc",
+        "let_agreed",
+    )
+
+    def __init__(self, features: str = "html.parser"):
+        from bs4 import BeautifulSoup
+
+        self._soup = lambda html: BeautifulSoup(html, features)
+
+    def tree(self, html: str):
+        return self._soup(html)
+
+    def parse_listing(self, html: str) -> Dict[str, Any]:
+        listing = empty_listing()
+        soup = self.tree(html)
+        self.rent(soup, listing)
+        self.letting_details(soup, listing)
+        self.property_details(soup, listing)
+        self.epc(soup, listing)
+        self.let_agreed(soup, listing)
+        return listing
+
+    def rent(self, soup, listing: Dict[str, Any]):
+        if rent := soup.select_one(RENT_SELECTOR):
+            listing["rent_pcm"] = rent.text
+
+    def letting_details(self, soup, listing: Dict[str, Any]):
+        for dl in soup.select(LETTING_DETAILS_SELECTOR):
+            field = format_field_name(dl.dt.string)
+            if field in listing:
+                listing[field] = str(
+                    dl.dd.string
+                    or dl.dd.span.next_sibling
+                    or dl.dd.span.previous_sibling
+                )
+
+    def property_details(self, soup, listing: Dict[str, Any]):
+        for dl in soup.select(PROPERTY_DETAILS_SELECTOR):
+            field = format_field_name(dl.dt.string)
+            if field in listing:
+                listing[field] = str(dl.dd.string)
+
+    def epc(self, soup, listing: Dict[str, Any]):
+        if epc_rating := soup.select_one(EPC_SELECTOR):
+            listing["epc_rating_url"] = epc_rating["href"]
+
+    def let_agreed(self, soup, listing: Dict[str, Any]):
+        listing["let_agreed"] = bool(soup.select(LET_AGREED_SELECTOR))
+
+    def parse_search_page(self, html: str) -> SearchPage:
+        soup = self.tree(html)
+        return self.search_cards(soup), self.result_count(soup)
+
+    def parse_search(self, html: str) -> List[Dict[str, Any]]:
+        return self.search_cards(self.tree(html))
+
+    def parse_result_count(self, html: str) -> Optional[int]:
+        return self.result_count(self.tree(html))
+
+    def search_cards(self, soup) -> List[Dict[str, Any]]:
+        cards = []
+        for _property in soup.find_all(
+            "div", id=CARD_ID, class_=["l-searchResult", "is-list"]
+        ):
+            property_url = _property.find("a", class_="propertyCard-link")["href"]
+            rent = _property.select_one(CARD_RENT_SELECTOR)
+            cards.append(
+                {
+                    "property_id": property_id_from_url(property_url),
+                    "property_url": property_url,
+                    "image": _property.find("img", itemprop="image")["src"],
+                    "title": _property.find(
+                        "h2", class_="propertyCard-title"
+                    ).text.strip(),
+                    "description": _property.find(
+                        "span", itemprop="description"
+                    ).text.strip(),
+                    "rent_pcm": rent.text.strip() if rent else "",
+                }
+            )
+        return cards
+
+    def result_count(self, soup) -> Optional[int]:
+        if count := soup.select_one(RESULT_COUNT_SELECTOR):
+            return to_count(count.text)
+        return None
+
+
+class SelectolaxParser:
+    name = "selectolax"
+    listing_stages = ("rent", "details", "epc", "let_agreed")
+
+    def __init__(self):
+        # The lexbor backend, selectolax 1.0 dropped the modest one
+        from selectolax.lexbor import LexborHTMLParser
+
+        self._tree = LexborHTMLParser
+
+    def tree(self, html: str):
+        return self._tree(html)
+
+    def parse_listing(self, html: str) -> Dict[str, Any]:
+        listing = empty_listing()
+        tree = self.tree(html)
+        self.rent(tree, listing)
+        self.details(tree, listing)
+        self.epc(tree, listing)
+        self.let_agreed(tree, listing)
+        return listing
+
+    def rent(self, tree, listing: Dict[str, Any]):
+        if rent := tree.css_first(RENT_SELECTOR):
+            listing["rent_pcm"] = rent.text()
+
+    def details(self, tree, listing: Dict[str, Any]):
+        """Letting and property details, both are dt/dd pairs"""
+        for dl in tree.css(LETTING_DETAILS_SELECTOR) + tree.css(
+            PROPERTY_DETAILS_SELECTOR
+        ):
+            dt, dd = dl.css_first("dt"), dl.css_first("dd")
+            if dt is None or dd is None:
+                continue
+            field = format_field_name(dt.text())
+            if field in listing:
+                # Skip the text of the tooltip spans some values come with
+                listing[field] = dd.text(deep=False).strip() or dd.text().strip()
+
+    def epc(self, tree, listing: Dict[str, Any]):
+        if epc_rating := tree.css_first(EPC_SELECTOR):
+            listing["epc_rating_url"] = epc_rating.attributes.get("href") or ""
+
+    def let_agreed(self, tree, listing: Dict[str, Any]):
+        listing["let_agreed"] = tree.css_first(LET_AGREED_SELECTOR) is not None
+
+    def parse_search_page(self, html: str) -> SearchPage:
+        tree = self.tree(html)
+        return self.search_cards(tree), self.result_count(tree)
+
+    def parse_search(self, html: str) -> List[Dict[str, Any]]:
+        return self.search_cards(self.tree(html))
+
+    def parse_result_count(self, html: str) -> Optional[int]:
+        return self.result_count(self.tree(html))
+
+    def search_cards(self, tree) -> List[Dict[str, Any]]:
+        cards = []
+        for _property in tree.css("div.l-searchResult"):
+            if not CARD_ID.fullmatch(_property.attributes.get("id") or ""):
+                continue
+            property_url = _property.css_first("a.propertyCard-link").attributes[
+                "href"
+            ]
+            rent = _property.css_first(CARD_RENT_SELECTOR)
+            cards.append(
+                {
+                    "property_id": property_id_from_url(property_url),
+                    "property_url": property_url,
+                    "image": _property.css_first('img[itemprop="image"]').attributes[
+                        "src"
+                    ],
+                    "title": _property.css_first("h2.propertyCard-title")
+                    .text()
+                    .strip(),
+                    "description": _property.css_first(
+                        'span[itemprop="description"]'
+                    )
+                    .text()
+                    .strip(),
+                    "rent_pcm": rent.text().strip() if rent else "",
+                }
+            )
+        return cards
+
+    def result_count(self, tree) -> Optional[int]:
+        if count := tree.css_first(RESULT_COUNT_SELECTOR):
+            return to_count(count.text())
+        return None
+
+
+def extract_json_model(html: str, variable: str):
+    """Decode the `window.<variable> = {...}` object embedded in a page"""
+    marker = f"window.{variable}"
+    if (start := html.find(marker)) == -1:
+        return None
+    if (start := html.find("{", start + len(marker))) == -1:
+        return None
+    try:
+        model, _ = json.JSONDecoder().raw_decode(html, start)
+    except ValueError:
+        return None
+    return model
+
+
+class JsonModelParser:
+    name = "json"
+    # Fields are read straight off the decoded model, there are no stages
+    listing_stages = ()
+
+    def __init__(self):
+        self.fallback = Bs4Parser()
+
+    def tree(self, html: str):
+        return extract_json_model(html, "PAGE_MODEL")
+
+    def parse_listing(self, html: str) -> Dict[str, Any]:
+        if (model := extract_json_model(html, "PAGE_MODEL")) is None:
+            return self.fallback.parse_listing(html)
+
+        data = model.get("propertyData") or {}
+        lettings = data.get("lettings") or {}
+        listing = empty_listing()
+
+        listing["rent_pcm"] = (data.get("prices") or {}).get("primaryPrice") or ""
+        listing["let_available_date"] = lettings.get("letAvailableDate") or ""
+        if (deposit := lettings.get("deposit")) is not None:
+            listing["deposit"] = f"£{deposit:,}"
+        if months := lettings.get("minimumTermInMonths"):
+            listing["min_tenancy"] = f"{months} months"
+        listing["let_type"] = lettings.get("letType") or ""
+        listing["furnish_type"] = lettings.get("furnishType") or ""
+        listing["property_type"] = data.get("propertySubType") or ""
+        if bedrooms := data.get("bedrooms"):
+            listing["bedrooms"] = f"×{bedrooms}"
+        if bathrooms := data.get("bathrooms"):
+            listing["bathrooms"] = f"×{bathrooms}"
+        for sizing in data.get("sizings") or []:
+            if sizing.get("unit") == "sqft":
+                listing["size"] = f"{sizing['minimumSize']:,} sq ft"
+                break
+        if epc_graphs := data.get("epcGraphs"):
+            listing["epc_rating_url"] = epc_graphs[0].get("url") or ""
+
+        listing["let_agreed"] = "LET_AGREED" in (data.get("tags") or [])
+        return listing
+
+    def parse_search_page(self, html: str) -> SearchPage:
+        if (model := extract_json_model(html, "jsonModel")) is None:
+            return self.fallback.parse_search_page(html)
+        return self.search_cards(model), to_count(model.get("resultCount"))
+
+    def parse_search(self, html: str) -> List[Dict[str, Any]]:
+        if (model := extract_json_model(html, "jsonModel")) is None:
+            return self.fallback.parse_search(html)
+        return self.search_cards(model)
+
+    def search_cards(self, model) -> List[Dict[str, Any]]:
+        cards = []
+        for _property in model.get("properties") or []:
+            property_url = _property.get("propertyUrl") or ""
+            prices = (_property.get("price") or {}).get("displayPrices")
+            cards.append(
+                {
+                    "property_id": property_id_from_url(property_url),
+                    "property_url": property_url,
+                    "image": (_property.get("propertyImages") or {}).get(
+                        "mainImageSrc"
+                    )
+                    or "",
+                    "title": (_property.get("propertyTypeFullDescription") or "").strip(),
+                    "description": (_property.get("summary") or "").strip(),
+                    "rent_pcm": (prices[0].get("displayPrice") or "") if prices else "",
+                }
+            )
+        return cards
+
+    def parse_result_count(self, html: str) -> Optional[int]:
+        if (model := extract_json_model(html, "jsonModel")) is None:
+            return self.fallback.parse_result_count(html)
+        return to_count(model.get("resultCount"))
+
+
+PARSERS = {
+    Bs4Parser.name: Bs4Parser,
+    SelectolaxParser.name: SelectolaxParser,
+    JsonModelParser.name: JsonModelParser,
+}
+
+
+@lru_cache
+def get_parser(name: str = "bs4"):
+    if name not in PARSERS:
+        raise ValueError(
+            f"Unknown parser {name}. Valid parsers: {', '.join(PARSERS.keys())}"
+        )
+    return PARSERS[name]()
@@ -0,0 +1,54 @@
+"""The columnar batches property records are loaded in.
+
+Numeric fields (rent, deposit, bedrooms, bathrooms, size) are ints and
+floats, None when the listing doesn't give them, so the warehouse gets typed
+columns instead of text. They are typed by the normalize stage.
+"""
+from typing import Any, Dict, Iterator, List, Mapping
+
+FIELDS = (
+    "property_id",
+    "property_url",
+    "location_name",
+    "rent_pcm",
+    "let_available_date",
+    "deposit",
+    "min_tenancy",
+    "let_type",
+    "furnish_type",
+    "property_type",
+    "bedrooms",
+    "bathrooms",
+    "size",
+    "epc_rating_url",
+    "title",
+    "image",
+    "description",
+    "date_added",
+    # property_id of the oldest listing of its near-duplicates, see dedup.py
+    "cluster_id",
+)
+
+
+class RecordBatch:
+    """Records held column by column.
+
+    Behaves as a list of row dicts for `Database.load_data`, which loads rows;
+    the rows are only built while the batch is being loaded.
+    """
+
+    def __init__(self):
+        self.columns: Dict[str, List[Any]] = {name: [] for name in FIELDS}
+
+    @classmethod
+    def from_columns(cls, columns: Mapping[str, List[Any]]) -> "RecordBatch":
+        batch = cls()
+        batch.columns = {name: list(columns[name]) for name in FIELDS}
+        return batch
+
+    def __len__(self) -> int:
+        return len(self.columns["property_id"])
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for values in zip(*self.columns.values()):
+            yield dict(zip(FIELDS, values))
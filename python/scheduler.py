@@ -0,0 +1,376 @@
+"""Request scheduling for the crawlers.
+
+Every request goes through a `RequestScheduler`, which keeps per host:
+
+- a token bucket capping the request rate
+- an AIMD concurrency limit: it drops multiplicatively when the host says
+  it's overloaded (429, 503 and timeouts) and grows back by one slot per window
+  of healthy responses. Requests over the limit wait for a slot to be released
+- a circuit breaker that fails requests straight away for `breaker_cooldown`
+  seconds after `breaker_threshold` requests in a row failed
+
+Failed requests (5xx, 429, transport errors) are retried with jittered
+exponential backoff (honouring Retry-After) while the retry budget, a fraction
+of all requests sent, lasts. A response whose body can't be decoded isn't
+retried.
+The time spent waiting on each of these is reported by `report`.
+
+With a cache (the crawler `cache` parameter the client was built with), the
+cache is asked first. Responses it has, and replay misses, are returned
+without a token, a slot or a say in the limit and the breaker.
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+import httpx
+
+from .http_cache import CACHE_ONLY, FROM_CACHE
+
+# Statuses of a host asking for fewer requests
+THROTTLE_STATUSES = (429, 503)
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take a token, returning how long to wait before using it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveLimit:
+    def __init__(self, minimum: int, maximum: int, decrease: float = 0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        # Threads wait on the condition, tasks on a future of their loop
+        self.released = threading.Condition(self.lock)
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+
+    def _free(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def acquire(self):
+        with self.released:
+            self.released.wait_for(self._free)
+            self.in_flight += 1
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self._free():
+                    self.in_flight += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self.waiters.append(waiter)
+            try:
+                await waiter[1]
+            finally:
+                with self.lock:
+                    if waiter in self.waiters:
+                        self.waiters.remove(waiter)
+
+    def release(self, throttled: Optional[bool]):
+        """Give a slot back, None when the response says nothing of the host"""
+        with self.lock:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            elif throttled is not None:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            # Every waiter checks the limit again
+            self.released.notify_all()
+            for loop, future in self.waiters:
+                loop.call_soon_threadsafe(wake, future)
+            self.waiters = []
+
+
+def wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def check(self, host: str):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError(f"Too many failed requests to {host}")
+            # Half open: let requests through, the next failure opens it again
+            self.opened_at = None
+            self.failures = self.threshold - 1
+
+    def record(self, failed: bool):
+        with self.lock:
+            if not failed:
+                self.failures = 0
+            elif (failures := self.failures + 1) >= self.threshold:
+                self.failures = failures
+                self.opened_at = time.monotonic()
+            else:
+                self.failures = failures
+
+
+class Host:
+    def __init__(self, scheduler: "RequestScheduler"):
+        self.bucket = TokenBucket(scheduler.rate, scheduler.burst)
+        self.limit = AdaptiveLimit(scheduler.min_concurrency, scheduler.max_concurrency)
+        self.breaker = CircuitBreaker(
+            scheduler.breaker_threshold, scheduler.breaker_cooldown
+        )
+
+
+class RequestScheduler:
+    def __init__(
+        self,
+        rate: float = 5,
+        burst: float = 10,
+        min_concurrency: int = 1,
+        max_concurrency: int = 16,
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        retry_budget: float = 0.2,
+        breaker_threshold: int = 20,
+        breaker_cooldown: float = 60,
+        cached: bool = False,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.cached = cached
+
+        self.hosts: Dict[str, Host] = {}
+        self.lock = threading.Lock()
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "errors": 0,
+            "rejected": 0,
+            "cache_hits": 0,
+            "rate_wait": 0.0,
+            "concurrency_wait": 0.0,
+            "backoff_wait": 0.0,
+        }
+
+    @classmethod
+    def from_config(
+        cls,
+        config: Optional[Mapping[str, Any]],
+        max_concurrency: int,
+        cache: Optional[Mapping[str, Any]] = None,
+    ):
+        """Build a scheduler from the crawler `scheduler` and `cache` parameters"""
+        return cls(
+            max_concurrency=max_concurrency,
+            cached=(cache or {}).get("mode", "off") != "off",
+            **(config or {}),
+        )
+
+    def _host(self, host: str) -> Host:
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = Host(self)
+            return self.hosts[host]
+
+    def _count(self, stat: str, value: float = 1):
+        with self.lock:
+            self.stats[stat] += value
+
+    def _start(self, request: httpx.Request) -> Host:
+        host = self._host(request.url.host)
+        try:
+            host.breaker.check(request.url.host)
+        except CircuitOpenError:
+            self._count("rejected")
+            raise
+        return host
+
+    def _finish(
+        self,
+        host: Host,
+        attempt: int,
+        response: Optional[httpx.Response],
+        error: Optional[Exception],
+    ) -> Optional[float]:
+        """Release the request slot, returning the backoff before a retry if any"""
+        if response is not None and response.extensions.get(FROM_CACHE):
+            # Cached since the cache was asked, the host wasn't
+            host.limit.release(throttled=None)
+            self._count("cache_hits")
+            return None
+
+        self._count("requests")
+        if error is not None:
+            failed = True
+            throttled = isinstance(error, httpx.TimeoutException)
+        else:
+            failed = response.status_code == 429 or response.status_code >= 500
+            throttled = response.status_code in THROTTLE_STATUSES
+        # Other failures (a 500, a refused connection) say nothing of the load
+        host.limit.release(None if failed and not throttled else throttled)
+        if not failed:
+            host.breaker.record(failed=False)
+            return None
+
+        self._count("throttled" if throttled else "errors")
+        if error is not None and not isinstance(error, httpx.TransportError):
+            # The host answered, with a body that can't be decoded
+            return None
+        with self.lock:
+            can_retry = attempt < self.max_retries and self.stats["retries"] < max(
+                10, self.retry_budget * self.stats["requests"]
+            )
+            if can_retry:
+                self.stats["retries"] += 1
+        if not can_retry:
+            host.breaker.record(failed=True)
+            return None
+
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        delay = random.uniform(delay / 2, delay)
+        if response is not None and (retry_after := response.headers.get("retry-after")):
+            try:
+                delay = max(delay, min(self.backoff_max, float(retry_after)))
+            except ValueError:
+                pass
+        self._count("backoff_wait", delay)
+        return delay
+
+    def send(self, client: httpx.Client, url: str, **kwargs) -> httpx.Response:
+        """GET `url` with `client`, retrying throttled or failed requests"""
+        if self.cached:
+            response = client.send(
+                client.build_request(
+                    "GET", url, extensions={CACHE_ONLY: True}, **kwargs
+                )
+            )
+            if response.extensions.get(FROM_CACHE):
+                self._count("cache_hits")
+                return response
+            response.close()
+
+        request = client.build_request("GET", url, **kwargs)
+        attempt = 0
+        while True:
+            host = self._start(request)
+            start = time.monotonic()
+            host.limit.acquire()
+            self._count("concurrency_wait", time.monotonic() - start)
+
+            response, error = None, None
+            try:
+                if (wait := host.bucket.reserve()) > 0:
+                    self._count("rate_wait", wait)
+                    time.sleep(wait)
+                response = client.send(request)
+            except httpx.HTTPError as e:
+                # Connection errors, timeouts, bodies that can't be decoded...
+                error = e
+            except BaseException:
+                # Anything else still gives the slot back before going up
+                host.limit.release(throttled=None)
+                raise
+
+            if (delay := self._finish(host, attempt, response, error)) is None:
+                if error is not None:
+                    raise error
+                return response
+
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    async def asend(
+        self, client: httpx.AsyncClient, url: str, **kwargs
+    ) -> httpx.Response:
+        """Same as `send`, for an async client"""
+        if self.cached:
+            response = await client.send(
+                client.build_request(
+                    "GET", url, extensions={CACHE_ONLY: True}, **kwargs
+                )
+            )
+            if response.extensions.get(FROM_CACHE):
+                self._count("cache_hits")
+                return response
+            await response.aclose()
+
+        request = client.build_request("GET", url, **kwargs)
+        attempt = 0
+        while True:
+            host = self._start(request)
+            start = time.monotonic()
+            await host.limit.aacquire()
+            self._count("concurrency_wait", time.monotonic() - start)
+
+            response, error = None, None
+            try:
+                if (wait := host.bucket.reserve()) > 0:
+                    self._count("rate_wait", wait)
+                    await asyncio.sleep(wait)
+                response = await client.send(request)
+            except httpx.HTTPError as e:
+                error = e
+            except BaseException:
+                # Including a cancelled task
+                host.limit.release(throttled=None)
+                raise
+
+            if (delay := self._finish(host, attempt, response, error)) is None:
+                if error is not None:
+                    raise error
+                return response
+
+            if response is not None:
+                await response.aclose()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            report = dict(self.stats)
+            report["concurrency_limit"] = {
+                name: round(host.limit.limit, 1) for name, host in self.hosts.items()
+            }
+        for stat in ("rate_wait", "concurrency_wait", "backoff_wait"):
+            report[stat] = round(report[stat], 1)
+        return report
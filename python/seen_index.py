@@ -0,0 +1,89 @@
+"""Index of the listings already crawled, for incremental detail crawls.
+
+Each property_id is stored with a fingerprint of its search card. A listing
+whose card fingerprint hasn't changed since its detail page was last fetched
+can be skipped.
+
+The index is the warehouse table named by the crawler `seen_index` parameter,
+in the intermediate schema, so it outlives the container a run goes in. Rows are
+only ever appended, which lets the shards of a sharded crawl write to it at
+the same time; the latest row of a property is its fingerprint.
+merge_property_details compacts the table to those rows once the crawl is done.
+"""
+import hashlib
+from datetime import datetime
+from typing import Any, Iterable, List, Mapping
+
+from sayn.database import Database
+
+from .checkpoint import table_ddl
+
+CARD_FIELDS = ("property_url", "title", "description", "image", "rent_pcm")
+COLUMNS = {
+    "property_id": "STRING",
+    "fingerprint": "STRING",
+    "last_fetched": "TIMESTAMP",
+}
+
+
+def fingerprint(_property: Mapping[str, Any]) -> str:
+    card = "\x1f".join(str(_property.get(k) or "") for k in CARD_FIELDS)
+    return hashlib.sha1(card.encode()).hexdigest()
+
+
+def latest_query(table: str) -> str:
+    """Latest fingerprint of each property"""
+    return f"""
+    SELECT property_id, fingerprint, last_fetched
+      FROM (
+        SELECT *
+             , ROW_NUMBER() OVER (PARTITION BY property_id ORDER BY last_fetched DESC) AS n
+          FROM {table}
+        )
+    WHERE n = 1
+    """
+
+
+class SeenIndex:
+    def __init__(self, warehouse: Database, table: str, schema: str):
+        self.warehouse = warehouse
+        self.table = table
+        self.schema = schema
+        self.ddl = table_ddl(warehouse, COLUMNS)
+        columns = ", ".join(f"{c['name']} {c['type']}" for c in self.ddl["columns"])
+        warehouse.execute(f"CREATE TABLE IF NOT EXISTS {schema}.{table} ({columns})")
+        self.pending = {}
+
+    def changed(
+        self, properties: Iterable[Mapping[str, Any]]
+    ) -> List[Mapping[str, Any]]:
+        """Keep the properties that are new or whose card changed"""
+        known = {
+            row["property_id"]: row["fingerprint"]
+            for row in self.warehouse.read_data(
+                latest_query(f"{self.schema}.{self.table}")
+            )
+        }
+        return [p for p in properties if known.get(p["property_id"]) != fingerprint(p)]
+
+    def mark(self, _property: Mapping[str, Any]):
+        """Record a fetched property, written on `commit`"""
+        self.pending[_property["property_id"]] = fingerprint(_property)
+
+    def commit(self):
+        now = datetime.now()
+        self.warehouse.load_data(
+            self.table,
+            [
+                {"property_id": k, "fingerprint": v, "last_fetched": now}
+                for k, v in self.pending.items()
+            ],
+            schema=self.schema,
+            **self.ddl,
+        )
+        self.pending = {}
+
+
+def compact_query(table: str) -> str:
+    """Replace the index by the latest row of each property"""
+    return f"CREATE OR REPLACE TABLE {table} AS {latest_query(table)}"
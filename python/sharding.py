@@ -0,0 +1,32 @@
+"""Deterministic partitioning of the crawl across workers.
+
+The shard count comes from the CRAWL_SHARD_COUNT environment variable or the
+crawler `shard_count` parameter, the shard index from CLOUD_RUN_TASK_INDEX
+(set on each task of a Cloud Run job) or the `shard_index` parameter. With more
+than one shard each worker writes to its own staging table, which the merge
+tasks in merge_shards combine. A worker only runs its crawl task, the merges
+run once every worker is done: scripts/daily.sh runs the project that way.
+"""
+import os
+import zlib
+from typing import Any, Mapping, Tuple
+
+
+def shard_config(crawler: Mapping[str, Any]) -> Tuple[int, int]:
+    """Return (shard index, shard count)"""
+    count = int(os.environ.get("CRAWL_SHARD_COUNT", crawler.get("shard_count", 1)))
+    index = int(os.environ.get("CLOUD_RUN_TASK_INDEX", crawler.get("shard_index", 0)))
+    if not 0 <= index < count:
+        raise ValueError(f"Shard index {index} out of range for {count} shards")
+    return index, count
+
+
+def in_shard(key: Any, index: int, count: int) -> bool:
+    # crc32 rather than hash(), which changes from one process to another
+    return zlib.crc32(str(key).encode()) % count == index
+
+
+def shard_table(table: str, index: int, count: int) -> str:
+    if count == 1:
+        return table
+    return f"{table}_shard_{index}_of_{count}"
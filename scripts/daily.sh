@@ -1,3 +1,54 @@
 #!/bin/bash
+# The daily run. Arguments (eg: -f) are passed on to sayn.
+#
+# With CRAWL_SHARD_COUNT above 1 each crawl is split over that many workers,
+# each crawling its shard into a staging table. The merges and the rest of the
+# project run once, after every worker of the crawl has finished. Workers are
+# the tasks of the Cloud Run job CRAWL_JOB (this image, CLOUD_RUN_TASK_INDEX
+# picks the shard) or, without CRAWL_JOB, processes on this machine.
+set -euo pipefail
 
-sayn run -d
+shards=${CRAWL_SHARD_COUNT:-1}
+
+if [ "${1:-}" = "shard" ]; then
+  # A worker: daily.sh shard <task> [sayn arguments]
+  task=$2
+  shift 2
+  exec sayn run -d -t "$task" "$@"
+fi
+
+if [ "$shards" -le 1 ]; then
+  exec sayn run -d "$@"
+fi
+
+crawl() {
+  local task=$1
+  shift
+  if [ -n "${CRAWL_JOB:-}" ]; then
+    local args
+    args=$(IFS=,; echo "scripts/daily.sh,shard,$task,$*")
+    gcloud run jobs execute "$CRAWL_JOB" --wait --tasks "$shards" \
+      --update-env-vars "CRAWL_SHARD_COUNT=$shards" --args "${args%,}"
+    return
+  fi
+
+  local pids=() failed=0
+  for ((i = 0; i < shards; i++)); do
+    CLOUD_RUN_TASK_INDEX=$i "$0" shard "$task" "$@" &
+    pids+=($!)
+  done
+  for pid in "${pids[@]}"; do
+    wait "$pid" || failed=1
+  done
+  return $failed
+}
+
+sayn run -d -t extract_locations "$@"
+crawl extract_property_links "$@"
+sayn run -d -t merge_property_links "$@"
+crawl extract_property_details "$@"
+sayn run -d "$@" \
+  -x extract_locations \
+  -x extract_property_links \
+  -x merge_property_links \
+  -x extract_property_details
@@ -1,26 +1,198 @@
 #!/usr/bin/env python
+"""HTTP job service running the SAYN project on Cloud Run.
 
-from http.server import HTTPServer, BaseHTTPRequestHandler
+- POST /runs starts a run and answers 202 with its id. The JSON body can
+  select tasks (eg: {"tasks": ["group:property_details"]}) and ask for a full
+  load ({"full_load": true}). With ?wait=true the request blocks until the
+  run ends and answers 200 or 500 depending on its exit code.
+- GET /runs/<id> returns the status and exit code of a run, GET /runs the
+  recent runs.
+- GET / is a health check, it never starts a run.
+
+Only one run happens at a time. A trigger for the run already going on gets
+that run back, a trigger for a different one gets a 409.
+
+A run answered with a 202 goes on after its request. Cloud Run throttles the
+CPU of an instance outside requests, so the service has to be deployed with
+the CPU always allocated (gcloud run deploy --no-cpu-throttling), or the
+runs triggered with ?wait=true.
+
+SAYN is imported once at start up and each run is a fork of this warm
+process, so runs don't pay the interpreter and import start up time. A sharded
+crawl (CRAWL_SHARD_COUNT above 1) has to run its shards before merging them, a
+run without tasks then runs scripts/daily.sh instead.
+"""
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+import json
+import multiprocessing
 import os
-import sys
+import re
 import subprocess
-import requests
+import threading
+import uuid
+from datetime import datetime
+
+from sayn.cli import cli
+
+# Same as scripts/daily.sh without shards
+DEFAULT_ARGS = ["run", "-d"]
+DAILY_SCRIPT = "scripts/daily.sh"
+TASK_TARGET = re.compile(r"[\w.:\-]+")
+MAX_RUNS_KEPT = 50
+
+
+def run_sayn(args):
+    cli.main(args=args, prog_name="sayn", standalone_mode=True)
+
+
+class Run:
+    def __init__(self, args):
+        self.id = uuid.uuid4().hex[:12]
+        self.args = args
+        self.status = "running"
+        self.exit_code = None
+        self.started = datetime.now()
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "args": self.args,
+            "status": self.status,
+            "exit_code": self.exit_code,
+            "started": self.started.isoformat(),
+            "finished": self.finished.isoformat() if self.finished else None,
+        }
+
+
+class JobService:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.current = None
+        self.context = multiprocessing.get_context("fork")
+
+    def trigger(self, args):
+        """Return (run, started) where started is False for a coalesced trigger"""
+        with self.lock:
+            if self.current is not None:
+                return self.current, False
+
+            run = Run(args)
+            self.current = run
+            self.runs[run.id] = run
+            for old_id in list(self.runs)[:-MAX_RUNS_KEPT]:
+                del self.runs[old_id]
+
+        threading.Thread(target=self._execute, args=(run,), daemon=True).start()
+        return run, True
+
+    def _execute(self, run):
+        try:
+            if run.args[0] == DAILY_SCRIPT:
+                run.exit_code = subprocess.run(run.args).returncode
+            else:
+                process = self.context.Process(target=run_sayn, args=(run.args,))
+                process.start()
+                process.join()
+                run.exit_code = process.exitcode
+        except Exception:
+            run.exit_code = -1
+
+        run.status = "succeeded" if run.exit_code == 0 else "failed"
+        run.finished = datetime.now()
+        with self.lock:
+            self.current = None
+        run.done.set()
+
+
+service = JobService()
+
+
+def sayn_args(body):
+    if not isinstance(body, dict):
+        raise ValueError("The body must be a JSON object")
+    if not isinstance(body.get("tasks") or [], list):
+        raise ValueError("tasks must be a list")
+    if not body.get("tasks") and int(os.environ.get("CRAWL_SHARD_COUNT", 1)) > 1:
+        return [DAILY_SCRIPT] + (["-f"] if body.get("full_load") else [])
+
+    args = list(DEFAULT_ARGS)
+    for target in body.get("tasks") or []:
+        if not isinstance(target, str) or not TASK_TARGET.fullmatch(target):
+            raise ValueError(f"Invalid task {target}")
+        args += ["-t", target]
+    if body.get("full_load"):
+        args.append("-f")
+    return args
 
 
 class S(BaseHTTPRequestHandler):
+    def send_json(self, code, data, headers=None):
+        payload = json.dumps(data).encode("utf8")
+        self.send_response(code)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
     def do_GET(self):
+        path = urlparse(self.path).path.rstrip("/")
+        if path in ("", "/healthz"):
+            current = service.current
+            self.send_json(
+                200,
+                {"status": "ok", "current": current.to_dict() if current else None},
+            )
+        elif path == "/runs":
+            with service.lock:
+                runs = [run.to_dict() for run in service.runs.values()]
+            self.send_json(200, runs)
+        elif path.startswith("/runs/") and (
+            run := service.runs.get(path[len("/runs/") :])
+        ):
+            self.send_json(200, run.to_dict())
+        else:
+            self.send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path.rstrip("/") != "/runs":
+            self.send_json(404, {"error": "Not found"})
+            return
+
         try:
-            subprocess.run(sys.argv[1:], env=os.environ.copy())
-        except:
-            pass
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            args = sayn_args(body)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
 
-        self.send_response(200)
-        self.send_header("Content-type", "text/plain")
-        self.end_headers()
-        self.wfile.write("OK".encode("utf8"))
-        sys.exit(1)
+        run, started = service.trigger(args)
+        if not started and run.args != args:
+            self.send_json(
+                409, {"error": "Another run is in progress", "run": run.to_dict()}
+            )
+            return
+
+        if parse_qs(url.query).get("wait", ["false"])[0].lower() == "true":
+            run.done.wait()
+            self.send_json(200 if run.exit_code == 0 else 500, run.to_dict())
+            return
+
+        self.send_json(
+            202,
+            dict(run.to_dict(), coalesced=not started),
+            headers={"Location": f"/runs/{run.id}"},
+        )
 
 
 if __name__ == "__main__":
-    httpd = HTTPServer(("", int(os.environ["PORT"])), S)
+    httpd = ThreadingHTTPServer(("", int(os.environ["PORT"])), S)
     httpd.serve_forever()
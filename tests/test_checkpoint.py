@@ -0,0 +1,96 @@
+"""ChunkedLoader against a sqlite warehouse, as SAYN builds it."""
+import asyncio
+from datetime import datetime
+
+import pytest
+from sayn.database.creator import create
+
+from python.checkpoint import Checkpoint, ChunkedLoader
+from python.extract_property_details import FACT_COLUMNS
+from python.normalize import normalize_listings
+from python.parsers import empty_listing
+
+
+@pytest.fixture
+def warehouse(tmp_path):
+    db = create(
+        "warehouse",
+        "warehouse",
+        {"type": "sqlite", "database": str(tmp_path / "warehouse.db")},
+    )
+    db._activate_connection()
+    return db
+
+
+def details_loader(
+    warehouse, tmp_path, run_id: str = "2024-06-01", **kwargs
+) -> ChunkedLoader:
+    checkpoint = Checkpoint(str(tmp_path / "checkpoints"), "details", run_id)
+    return ChunkedLoader(
+        warehouse,
+        "property_details",
+        None,
+        checkpoint,
+        chunk_size=10,
+        replace=True,
+        prepare=lambda rows: normalize_listings(rows, (), datetime(2024, 6, 1))[0],
+        columns=FACT_COLUMNS,
+        **kwargs,
+    )
+
+
+def listing(property_id: str, **fields):
+    return dict(
+        empty_listing(),
+        property_id=property_id,
+        property_url=f"/properties/{property_id}",
+        location_name="London",
+        title="2 bedroom flat",
+        image="",
+        description="",
+        cluster_id=property_id,
+        let_available_date="Now",
+        **fields,
+    )
+
+
+def test_missing_numbers_load_as_null(warehouse, tmp_path):
+    # No deposit, bathrooms or size, the first record has None in those columns
+    loader = details_loader(warehouse, tmp_path)
+    loader.add([listing("0123", rent_pcm="£1,500 pcm", bedrooms="×2")], ["0123"])
+    loader.close()
+
+    (row,) = warehouse.read_data("SELECT * FROM property_details")
+    assert row["property_id"] == "0123"
+    assert row["rent_pcm"] == 1500
+    assert row["bedrooms"] == 2
+    assert row["deposit"] is None
+    assert row["size"] is None
+
+
+def test_nothing_found_empties_the_table(warehouse, tmp_path):
+    loader = details_loader(warehouse, tmp_path)
+    loader.add([listing("1", rent_pcm="£900 pcm")], ["1"])
+    loader.close()
+
+    # The next day finds nothing, yesterday's details must not stay
+    details_loader(warehouse, tmp_path, run_id="2024-06-02").close()
+
+    assert warehouse.read_data("SELECT * FROM property_details") == []
+
+
+def test_chunks_added_from_a_loop_are_all_loaded(warehouse, tmp_path):
+    loader = details_loader(warehouse, tmp_path)
+
+    async def crawl(start: int):
+        for i in range(start, start + 25):
+            await loader.aadd([listing(str(i), rent_pcm="£900 pcm")], [str(i)])
+
+    async def main():
+        await asyncio.gather(crawl(0), crawl(100))
+
+    asyncio.run(main())
+    loader.close()
+
+    rows = warehouse.read_data("SELECT property_id FROM property_details")
+    assert len(rows) == 50
@@ -0,0 +1,109 @@
+"""RequestScheduler slots, and what the response cache answers on its own."""
+import asyncio
+
+import httpx
+import pytest
+
+from python.http_cache import CachingTransport, ResponseCache
+from python.scheduler import RequestScheduler
+
+
+def bad_gzip(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(
+        200, headers={"Content-Encoding": "gzip"}, content=b"not gzip"
+    )
+
+
+def test_decoding_errors_release_their_slot():
+    scheduler = RequestScheduler(max_concurrency=2, max_retries=0, rate=100)
+    client = httpx.Client(
+        transport=httpx.MockTransport(bad_gzip), base_url="http://site"
+    )
+    for _ in range(3):
+        with pytest.raises(httpx.DecodingError):
+            scheduler.send(client, "/page")
+
+    limit = scheduler.hosts["site"].limit
+    assert limit.in_flight == 0
+    # The host answered, it isn't a sign of overload
+    assert limit.limit == 2
+    assert scheduler.report()["errors"] == 3
+
+
+def test_cancelled_request_releases_its_slot():
+    async def ok(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200)
+
+    async def main():
+        # One token, the second request waits on the rate limit until cancelled
+        scheduler = RequestScheduler(max_concurrency=2, rate=0.01, burst=1)
+        client = httpx.AsyncClient(
+            transport=httpx.MockTransport(ok), base_url="http://site"
+        )
+        await scheduler.asend(client, "/page")
+        waiting = asyncio.create_task(scheduler.asend(client, "/page"))
+        await asyncio.sleep(0.05)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        return scheduler.hosts["site"].limit.in_flight
+
+    assert asyncio.run(main()) == 0
+
+
+def test_requests_over_the_limit_wait_for_a_release():
+    async def slow(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(0.05)
+        return httpx.Response(200)
+
+    async def main():
+        scheduler = RequestScheduler(max_concurrency=1, rate=100)
+        client = httpx.AsyncClient(
+            transport=httpx.MockTransport(slow), base_url="http://site"
+        )
+        pages = [scheduler.asend(client, "/page") for _ in range(3)]
+        responses = await asyncio.gather(*pages)
+        return scheduler, [r.status_code for r in responses]
+
+    scheduler, statuses = asyncio.run(main())
+    assert statuses == [200, 200, 200]
+    assert scheduler.hosts["site"].limit.in_flight == 0
+    assert scheduler.report()["concurrency_wait"] >= 0.1
+
+
+def cached_client(tmp_path, mode: str, handler) -> httpx.Client:
+    cache = ResponseCache(str(tmp_path / "cache"), ttl=3600, max_size=1 << 20)
+    transport = CachingTransport(httpx.MockTransport(handler), cache, mode)
+    return httpx.Client(transport=transport, base_url="http://site")
+
+
+def test_replay_misses_are_not_retried(tmp_path):
+    scheduler = RequestScheduler(max_concurrency=4, cached=True)
+    client = cached_client(tmp_path, "replay", lambda request: httpx.Response(200))
+    for _ in range(10):
+        assert scheduler.send(client, "/missing").status_code == 504
+
+    report = scheduler.report()
+    assert report["requests"] == report["retries"] == report["throttled"] == 0
+    assert scheduler.hosts == {}
+
+
+def test_cache_hits_skip_the_rate_limit(tmp_path):
+    sent = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(request.url.path)
+        # A stream, as the network transports return
+        return httpx.Response(200, stream=httpx.ByteStream(b"page"))
+
+    scheduler = RequestScheduler(max_concurrency=2, rate=0.01, burst=1, cached=True)
+    client = cached_client(tmp_path, "on", handler)
+    scheduler.send(client, "/page")
+    for _ in range(20):
+        assert scheduler.send(client, "/page").text == "page"
+
+    assert sent == ["/page"]
+    report = scheduler.report()
+    assert report["requests"] == 1
+    assert report["cache_hits"] == 20
+    assert report["rate_wait"] == 0